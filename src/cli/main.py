@@ -1,10 +1,12 @@
-import json
 import logging
 import os
 import time
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
@@ -16,16 +18,29 @@ CHAT_URL = f"{API_URL}/chat"
 HEALTH_URL = f"{API_URL}/health"
 
 STARTUP_TIMEOUT = 180
+# Read size for the chat stream, frames are split out of the raw bytes as they arrive
+STREAM_CHUNK_SIZE = 16384
+# The terminal is flushed once this many characters are pending or this long has passed, not on every token
+FLUSH_MIN_CHARS = 32
+FLUSH_INTERVAL = 0.05
 
 chat_history: List[Dict[str, str]] = []
 
+# One keep-alive connection pool to the API for health checks and every chat turn
+SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=Retry(total=2, backoff_factor=0.1))
+SESSION.mount("http://", _ADAPTER)
+SESSION.mount("https://", _ADAPTER)
+# Compressed SSE would be buffered by the encoder before reaching the terminal; the body is pre-serialized with orjson
+STREAM_HEADERS = {"Accept-Encoding": "identity", "Content-Type": "application/json"}
+
 
 # --- CLI ---
 def wait_rag():
     start_time = time.time()
     while time.time() - start_time < STARTUP_TIMEOUT:
         try:
-            response = requests.get(HEALTH_URL)
+            response = SESSION.get(HEALTH_URL)
             if response.status_code == 200:
                 logger.info("RAG is ready.")
                 return True
@@ -41,27 +56,51 @@ def wait_rag():
     return False
 
 
-def _parse_sse(line: str) -> Optional[str]:
+def _iter_sse_lines(response: requests.Response) -> Iterator[bytes]:
+    """
+    Splits a streamed response into lines on b"\n" only, keeping the partial last line in a buffer between chunks.
+    """
+    buffer = bytearray()
+    for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+        start = len(buffer)
+        buffer += chunk
+        # Only the newly received bytes are scanned, the tail before them is known to hold no newline
+        end = buffer.find(b"\n", start)
+        if end == -1:
+            continue
+        pos = 0
+        while end != -1:
+            yield bytes(buffer[pos:end]).rstrip(b"\r")
+            pos = end + 1
+            end = buffer.find(b"\n", pos)
+        del buffer[:pos]
+    if buffer:
+        yield bytes(buffer).rstrip(b"\r")
+
+
+def _parse_sse(line: bytes) -> Optional[str]:
     """
-    Parses a single line of a Server-Sent Event (SSE) stream and returns the content.
-    Returns None if the line is not valid data.
+    Parses a single raw line of a Server-Sent Event (SSE) stream and returns the content.
+    Returns None if the line is not valid data. Non-data lines (comments, heartbeats) are dropped before any decoding.
     """
-    if not line.startswith("data:"):
+    if not line.startswith(b"data:"):
         return None
 
-    json_str = line[5:].lstrip()
+    json_str = line[5:].strip()
 
-    if not json_str or json_str == "[DONE]":
+    if not json_str or json_str == b"[DONE]":
         return None
 
     try:
-        data = json.loads(json_str)
-        delta = data.get("choices", [{}])[0].get("delta", {})
-        content = delta.get("content")
-        return content
-    except json.JSONDecodeError:
+        data = orjson.loads(json_str)
+    except orjson.JSONDecodeError:
         logger.warning(f"Failed to decode JSON chunk in SSE stream: {json_str}")
         return None
+    # Direct key walk: no default list/dicts allocated per token, frames without a delta (sources, role) fall through
+    try:
+        return data["choices"][0]["delta"]["content"]
+    except (KeyError, IndexError, TypeError):
+        return None
 
 
 def run_chatbot_cli():
@@ -92,30 +131,29 @@ def run_chatbot_cli():
 
             chat_history.append({"role": "user", "content": user_input})
             request_payload = {"query": user_input, "history": chat_history}
-            with requests.post(CHAT_URL, json=request_payload, stream=True, timeout=120) as response:
+            with SESSION.post(CHAT_URL, data=orjson.dumps(request_payload), stream=True, timeout=120, headers=STREAM_HEADERS) as response:
                 response.raise_for_status()
 
-                full_response = ""
+                response_parts: List[str] = []
                 print("\n\033[31mMichel\033[0m: ", end="", flush=True)
-
-                buffer = ""
-                for chunk in response.iter_content(chunk_size=1024, decode_unicode=True):
-                    if chunk:
-                        buffer += chunk
-
-                        while "\n\n" in buffer:
-                            message, buffer = buffer.split("\n\n", 1)
-                            content = _parse_sse(message)
-                            if content:
-                                full_response += content
-                                print(content, end="", flush=True)
-
-                final_content = _parse_sse(buffer.strip())
-                if final_content:
-                    full_response += final_content
-                    print(final_content, end="", flush=True)
-
-                print("\n")
+                unflushed = 0
+                last_flush = time.monotonic()
+
+                # Raw bytes lines: only data frames get parsed (orjson parses the payload bytes directly)
+                for line in _iter_sse_lines(response):
+                    content = _parse_sse(line)
+                    if content:
+                        response_parts.append(content)
+                        unflushed += len(content)
+                        now = time.monotonic()
+                        flush = unflushed >= FLUSH_MIN_CHARS or now - last_flush >= FLUSH_INTERVAL
+                        print(content, end="", flush=flush)
+                        if flush:
+                            unflushed = 0
+                            last_flush = now
+
+                print("\n", flush=True)
+                full_response = "".join(response_parts)
                 if full_response:
                     chat_history.append({"role": "assistant", "content": full_response})
 
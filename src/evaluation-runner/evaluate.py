@@ -1,14 +1,14 @@
 import asyncio
-import json
 import logging
 import math
 import os
 import random
 import tempfile
 import time
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterator, List
 
 import boto3
+import orjson
 import requests
 from datasets import Dataset
 from fastembed import TextEmbedding
@@ -24,6 +24,8 @@ from ragas import RunConfig, evaluate
 from ragas.embeddings import LangchainEmbeddingsWrapper
 from ragas.llms import LangchainLLMWrapper
 from ragas.metrics import answer_correctness, answer_relevancy, context_precision, context_recall, faithfulness
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 from config import MODELS_CONFIG
 from config import settings as env
@@ -54,6 +56,15 @@ class SafeFastEmbed(Embeddings):
 
 
 # --- Utils ---
+# Keep-alive pool to the API shared by the login call and every question of an evaluation run
+SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=Retry(total=2, backoff_factor=0.1))
+SESSION.mount("http://", _ADAPTER)
+SESSION.mount("https://", _ADAPTER)
+# Read size for the chat stream, lines are split out of the raw bytes as they arrive
+STREAM_CHUNK_SIZE = 65536
+
+
 def get_s3_client():
     """
     Create a boto3 client for Minio/S3
@@ -117,11 +128,33 @@ def configure_embedding_model(user_choice: str):
     env.EMBEDDING_MODEL = config["name"]
 
 
+def iter_sse_lines(response: requests.Response) -> Iterator[bytes]:
+    """
+    Splits a streamed response into lines on b"\n" only, keeping the partial last line in a buffer between chunks.
+    """
+    buffer = bytearray()
+    for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+        start = len(buffer)
+        buffer += chunk
+        # Only the newly received bytes are scanned, the tail before them is known to hold no newline
+        end = buffer.find(b"\n", start)
+        if end == -1:
+            continue
+        pos = 0
+        while end != -1:
+            yield bytes(buffer[pos:end]).rstrip(b"\r")
+            pos = end + 1
+            end = buffer.find(b"\n", pos)
+        del buffer[:pos]
+    if buffer:
+        yield bytes(buffer).rstrip(b"\r")
+
+
 def get_service_auth_token() -> str | None:
     logger.info("Authenticating evaluation runner with the RAG Core API...")
     try:
         login_payload = {"username": env.SERVICE_ACCOUNT_EMAIL, "password": env.SERVICE_ACCOUNT_PASSWORD}
-        response = requests.post(f"{env.API_URL}/auth/token", data=login_payload, timeout=10)
+        response = SESSION.post(f"{env.API_URL}/auth/token", data=login_payload, timeout=10)
         response.raise_for_status()
         token = response.json().get("access_token")
         if not token:
@@ -175,41 +208,37 @@ def generate_synthetic_testset(documents: List, generator_llm: ChatOpenAI, size:
     return results
 
 
-def run_rag_pipeline(question: str, auth_token: str) -> Dict[str, Any]:
-    answer = ""
+def run_rag_pipeline(question: str) -> Dict[str, Any]:
+    answer_parts: List[str] = []
     contexts = []
     try:
-        headers = {"Authorization": f"Bearer {auth_token}"}
-        response = requests.post(f"{env.API_URL}/chat", json={"query": question, "history": []}, stream=True, timeout=120, headers=headers)
-        response.raise_for_status()
+        with SESSION.post(f"{env.API_URL}/chat", json={"query": question, "history": []}, stream=True, timeout=120) as response:
+            response.raise_for_status()
 
-        for line in response.iter_lines():
-            if not line:
-                continue
-            line_str = line.decode("utf-8").strip()
-            if not line_str.startswith("data:"):
-                continue
+            # Raw bytes lines: non-data frames are skipped without decoding, orjson parses the payload bytes directly
+            for line in iter_sse_lines(response):
+                if not line.startswith(b"data:"):
+                    continue
 
-            data_str = line_str[5:].strip()
-            if not data_str or data_str == "[DONE]":
-                continue
+                data_str = line[5:].strip()
+                if not data_str or data_str == b"[DONE]":
+                    continue
 
-            try:
-                data = json.loads(data_str)
-                if data.get("type") == "context":
-                    contexts = data.get("data", {}).get("texts", [])
-
-                else:
-                    choices = data.get("choices", [])
-                    if choices:
-                        delta = choices[0].get("delta", {})
-                        content = delta.get("content", "")
+                try:
+                    data = orjson.loads(data_str)
+                    if data.get("type") == "context":
+                        contexts = data.get("data", {}).get("texts", [])
+
+                    else:
+                        content = data["choices"][0]["delta"]["content"]
                         if content:
-                            answer += content
-            except json.JSONDecodeError:
-                logger.warning(f"Failed to decode JSON line: {data_str}")
-                continue
-        return {"answer": answer, "contexts": contexts}
+                            answer_parts.append(content)
+                except (KeyError, IndexError, TypeError):
+                    continue
+                except orjson.JSONDecodeError:
+                    logger.warning(f"Failed to decode JSON line: {data_str}")
+                    continue
+        return {"answer": "".join(answer_parts), "contexts": contexts}
     except Exception as e:
         logger.error(f"RAG Pipeline Error: {e}")
         return {"answer": "", "contexts": []}
@@ -225,6 +254,8 @@ async def run_evaluation_task():
             logger.error("Skipping evaluation run due to authentication failure.")
             EVALUATION_RUNS_TOTAL.labels(status="failed").inc()
             return
+        # Set once on the shared session instead of building the header dict for every question
+        SESSION.headers["Authorization"] = f"Bearer {auth_token}"
 
         EVALUATION_RUNS_TOTAL.labels(status="started").inc()
 
@@ -250,7 +281,7 @@ async def run_evaluation_task():
         logger.info("Running RAG pipeline...")
         results = []
         for item in testset_data:
-            rag_output = run_rag_pipeline(item["question"], auth_token)
+            rag_output = run_rag_pipeline(item["question"])
             if rag_output["answer"]:
                 results.append({"question": item["question"], "contexts": rag_output["contexts"], "answer": rag_output["answer"], "ground_truth": item["ground_truth"]})
         if not results:
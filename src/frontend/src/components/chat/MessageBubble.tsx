@@ -10,7 +10,8 @@ interface MessageBubbleProps {
 	message: Message;
 }
 
-export function MessageBubble({ message }: MessageBubbleProps) {
+// Memoized: while an answer streams only its own bubble re-renders, earlier turns keep their parsed markdown
+export const MessageBubble = React.memo(function MessageBubble({ message }: MessageBubbleProps) {
 	const isUser = message.role === 'user';
 
 	const processText = (text: string) => {
@@ -77,4 +78,4 @@ export function MessageBubble({ message }: MessageBubbleProps) {
 			</div>
 		</motion.div>
 	);
-}
+});
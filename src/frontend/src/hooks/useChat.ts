@@ -3,6 +3,13 @@ import type { Message, Source } from '../types';
 import { useAuth } from './useAuth';
 import { useSettings } from './useSettings';
 
+// Replaces the trailing assistant message with an updated copy, so memoized bubbles of earlier turns are not re-rendered
+function withLastAssistant(messages: Message[], patch: Partial<Message>): Message[] {
+	const lastMsg = messages[messages.length - 1];
+	if (lastMsg?.role !== 'assistant') return messages;
+	return [...messages.slice(0, -1), { ...lastMsg, ...patch }];
+}
+
 export function useChat() {
 	const [messages, setMessages] = useState<Message[]>([]);
 	const [isLoading, setIsLoading] = useState(false);
@@ -57,6 +64,7 @@ export function useChat() {
 		const userMessage: Message = { role: 'user', content };
 		setMessages(prev => [...prev, userMessage]);
 		setIsLoading(true);
+		let flushTimer: ReturnType<typeof setTimeout> | null = null;
 
 		try {
 			const response = await fetch('/api/chat', {
@@ -102,6 +110,20 @@ export function useChat() {
 			let sources: Source[] = [];
 			let isFirstChunk = true;
 			let buffer = '';
+			// Deltas are rendered at most every RENDER_INTERVAL_MS instead of re-rendering the markdown per token
+			const RENDER_INTERVAL_MS = 50;
+
+			const flushContent = () => {
+				flushTimer = null;
+				setMessages(prev => withLastAssistant(prev, { content: fullContent }));
+			};
+
+			const cancelFlush = () => {
+				if (flushTimer !== null) {
+					clearTimeout(flushTimer);
+					flushTimer = null;
+				}
+			};
 
 			const processLine = (line: string) => {
 				if (line.startsWith('data: ')) {
@@ -114,14 +136,8 @@ export function useChat() {
 						// Handle error messages from backend
 						if (data.type === 'error') {
 							const errorMessage = data.content || 'An error occurred';
-							setMessages(prev => {
-								const newMessages = [...prev];
-								const lastMsg = newMessages[newMessages.length - 1];
-								if (lastMsg.role === 'assistant') {
-									lastMsg.content = `Error: ${errorMessage}`;
-								}
-								return newMessages;
-							});
+							cancelFlush();
+							setMessages(prev => withLastAssistant(prev, { content: `Error: ${errorMessage}` }));
 							// Stop processing further
 							return;
 						}
@@ -129,14 +145,7 @@ export function useChat() {
 						if (data.type === 'sources') {
 							sources = data.data;
 							if (!isFirstChunk) {
-								setMessages(prev => {
-									const newMessages = [...prev];
-									const lastMsg = newMessages[newMessages.length - 1];
-									if (lastMsg.role === 'assistant') {
-										lastMsg.sources = sources;
-									}
-									return newMessages;
-								});
+								setMessages(prev => withLastAssistant(prev, { sources }));
 							}
 						} else if (data.choices?.[0]?.delta?.content) {
 							const content = data.choices[0].delta.content;
@@ -150,15 +159,8 @@ export function useChat() {
 								};
 								setMessages(prev => [...prev, assistantMessage]);
 								isFirstChunk = false;
-							} else {
-								setMessages(prev => {
-									const newMessages = [...prev];
-									const lastMsg = newMessages[newMessages.length - 1];
-									if (lastMsg.role === 'assistant') {
-										lastMsg.content = fullContent;
-									}
-									return newMessages;
-								});
+							} else if (flushTimer === null) {
+								flushTimer = setTimeout(flushContent, RENDER_INTERVAL_MS);
 							}
 						}
 					} catch (e) {
@@ -184,6 +186,7 @@ export function useChat() {
 								errorMessage = `Rate limit reached. Please try again in ${waitTime}.`;
 							}
 
+							cancelFlush();
 							setMessages(prev => {
 								// If we haven't started an assistant message yet, add one
 								if (isFirstChunk) {
@@ -193,12 +196,7 @@ export function useChat() {
 									}];
 								}
 								// Otherwise update the existing one
-								const newMessages = [...prev];
-								const lastMsg = newMessages[newMessages.length - 1];
-								if (lastMsg.role === 'assistant') {
-									lastMsg.content = `Error: ${errorMessage}`;
-								}
-								return newMessages;
+								return withLastAssistant(prev, { content: `Error: ${errorMessage}` });
 							});
 							return;
 						}
@@ -242,28 +240,15 @@ export function useChat() {
 				}
 
 				// Final update to ensure consistency
+				cancelFlush();
 				if (!isFirstChunk) {
-					setMessages(prev => {
-						const newMessages = [...prev];
-						const lastMsg = newMessages[newMessages.length - 1];
-						if (lastMsg.role === 'assistant') {
-							lastMsg.content = fullContent;
-							lastMsg.sources = sources;
-						}
-						return newMessages;
-					});
+					setMessages(prev => withLastAssistant(prev, { content: fullContent, sources }));
 				}
 			}
 		} catch (error) {
 			console.error('Error sending message:', error);
-			setMessages(prev => {
-				const newMessages = [...prev];
-				const lastMsg = newMessages[newMessages.length - 1];
-				if (lastMsg.role === 'assistant') {
-					lastMsg.content = `Sorry, I encountered an error. Please try again.\n\nDetails: ${error instanceof Error ? error.message : String(error)}`;
-				}
-				return newMessages;
-			});
+			if (flushTimer !== null) clearTimeout(flushTimer);
+			setMessages(prev => withLastAssistant(prev, { content: `Sorry, I encountered an error. Please try again.\n\nDetails: ${error instanceof Error ? error.message : String(error)}` }));
 		} finally {
 			setIsLoading(false);
 		}
@@ -62,7 +62,7 @@ export function useDocuments() {
 	const deleteDocument = async (filename: string) => {
 		if (!token) return;
 		try {
-			await axios.delete(`/api/documents/${filename}`, {
+			await axios.delete(`/api/documents/${encodeURIComponent(filename)}`, {
 				headers: { Authorization: `Bearer ${token}` }
 			});
 			await fetchDocuments();
@@ -77,21 +77,9 @@ export function useDocuments() {
 
 	useEffect(() => {
 		fetchDocuments();
-
-		// Poll for updates if any document is pending or processing
-		const interval = setInterval(() => {
-			setDocuments(currentDocs => {
-				const hasPending = currentDocs.some(doc => doc.status === 'pending' || doc.status === 'processing');
-				if (hasPending) {
-					return currentDocs;
-				}
-				return currentDocs;
-			});
-		}, 3000);
-
-		return () => clearInterval(interval);
 	}, []);
 
+	// Poll for updates only while a document is pending or processing
 	useEffect(() => {
 		const hasPending = documents.some(doc => doc.status === 'pending' || doc.status === 'processing');
 
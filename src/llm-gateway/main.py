@@ -12,9 +12,13 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(level
 logger = logging.getLogger(__name__)
 
 LITELLM_PROXY_URL = os.getenv("LITELLM_PROXY_URL", "http://litellm-proxy:8003")
+# Loaded once: building the BPE tables per request costs more than counting the prompt
+TOKENIZER = tiktoken.get_encoding("cl100k_base")
 
 # --- init ---
 app = FastAPI(title="LLM Gateway")
+# One keep-alive pool to the LiteLLM proxy for the whole process, closed on shutdown
+HTTP_CLIENT = httpx.AsyncClient(timeout=httpx.Timeout(120.0, connect=5.0), limits=httpx.Limits(max_connections=200, max_keepalive_connections=32))
 Instrumentator().instrument(app).expose(app)
 
 # Custom Metrics
@@ -32,23 +36,30 @@ async def startup_event():
     """
     logger.info("Fetching model info from LiteLLM...")
     url = f"{LITELLM_PROXY_URL}/model/info"
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(url)
-            if response.status_code == 200:
-                data = response.json()
-                for model in data.get("data", []):
-                    model_info = model.get("model_info", {})
-                    if model_info:
-                        LLM_MODEL_CONTEXT_WINDOW.labels(model=model_info.get("key", "unknown")).set(model_info.get("max_input_tokens"))
-                    model_params = model.get("litellm_params", {})
-                    if model_params:
-                        LLM_MODEL_RPM.labels(model=model_params.get("model", "unknown")).set(model_params.get("rpm"))
-                        LLM_MODEL_TPM.labels(model=model_params.get("model", "unknown")).set(model_params.get("tpm"))
-
-                logger.info("Model info metrics populated.")
-        except Exception as e:
-            logger.error(f"Failed to fetch model info: {e}")
+    try:
+        response = await HTTP_CLIENT.get(url, timeout=5.0)
+        if response.status_code == 200:
+            data = response.json()
+            for model in data.get("data", []):
+                model_info = model.get("model_info", {})
+                if model_info:
+                    LLM_MODEL_CONTEXT_WINDOW.labels(model=model_info.get("key", "unknown")).set(model_info.get("max_input_tokens"))
+                model_params = model.get("litellm_params", {})
+                if model_params:
+                    LLM_MODEL_RPM.labels(model=model_params.get("model", "unknown")).set(model_params.get("rpm"))
+                    LLM_MODEL_TPM.labels(model=model_params.get("model", "unknown")).set(model_params.get("tpm"))
+
+            logger.info("Model info metrics populated.")
+    except Exception as e:
+        logger.error(f"Failed to fetch model info: {e}")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """
+    Close the shared connection pool to LiteLLM.
+    """
+    await HTTP_CLIENT.aclose()
 
 
 # --- Endpoints ---
@@ -76,8 +87,7 @@ async def chat(request: Request):
     try:
         messages = request_body.get("messages", [])
         text = "".join([m.get("content", "") for m in messages])
-        enc = tiktoken.get_encoding("cl100k_base")
-        token_count = len(enc.encode(text))
+        token_count = len(TOKENIZER.encode_ordinary(text))
         LLM_TOKENS_ESTIMATED_TOTAL.labels(model=model, type="input").inc(token_count)
     except Exception as e:
         logger.warning(f"Failed to count tokens: {e}")
@@ -93,17 +103,16 @@ async def chat(request: Request):
     try:
 
         async def stream_proxy():
-            async with httpx.AsyncClient() as client:
-                async with client.stream("POST", url, json=request_body, headers=headers) as proxy_response:
-                    if proxy_response.status_code >= 400:
-                        error_content = await proxy_response.aread()
-                        logger.error(f"LiteLLM Proxy Error ({proxy_response.status_code}): {error_content.decode()}")
-                        yield error_content
-                        return
-
-                    proxy_response.raise_for_status()
-                    async for chunk in proxy_response.aiter_bytes():
-                        yield chunk
+            async with HTTP_CLIENT.stream("POST", url, json=request_body, headers=headers) as proxy_response:
+                if proxy_response.status_code >= 400:
+                    error_content = await proxy_response.aread()
+                    logger.error(f"LiteLLM Proxy Error ({proxy_response.status_code}): {error_content.decode()}")
+                    yield error_content
+                    return
+
+                proxy_response.raise_for_status()
+                async for chunk in proxy_response.aiter_bytes():
+                    yield chunk
 
         return StreamingResponse(stream_proxy(), media_type="text/event-stream")
     except Exception as e:
@@ -117,12 +126,11 @@ async def model_info():
     Proxy to LiteLLM's /model/info endpoint.
     """
     url = f"{LITELLM_PROXY_URL}/model/info"
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(url)
-            response.raise_for_status()
-            return response.json()
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=502, detail=f"Failed to connect to LiteLLM proxy: {e}")
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+    try:
+        response = await HTTP_CLIENT.get(url, timeout=5.0)
+        response.raise_for_status()
+        return response.json()
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=502, detail=f"Failed to connect to LiteLLM proxy: {e}")
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
@@ -14,6 +14,8 @@ from rag.retriever import orchestrate_rag_flow
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
+# French elisions (l', d', qu'...) split off so the query tokenizes like the indexed text
+_ELISION_RE = re.compile(r"(\b[ldjstnmc]|qu)'")
 
 router = APIRouter(
     prefix="/chat",
@@ -30,7 +32,7 @@ async def generate(request: GenerationRequest, current_user: models.User = Depen
         if not user.encrypted_api_key or not user.encrypted_side_api_key:
             logger.error("API key not found for user.")
             return StreamingResponse(content=json.dumps({"type": "error", "content": "API key not found."}), media_type="application/jsonlines", status_code=403)
-        formated_query = re.sub(r"(\b[ldjstnmc]|qu)'", r"\1 ", request.query.lower())
+        formated_query = _ELISION_RE.sub(r"\1 ", request.query.lower())
         response_generator = orchestrate_rag_flow(formated_query, user_id, db, request.temperature, request.strict_rag, request.rerank_threshold)
         return StreamingResponse(content=response_generator, media_type="text/event-stream")
     except Exception as e:
@@ -1,7 +1,6 @@
 import asyncio
 import logging
 from typing import List
-from urllib.parse import unquote
 
 from fastapi import APIRouter, Depends, File, HTTPException, UploadFile
 from sqlalchemy.orm import Session
@@ -25,7 +24,10 @@ router = APIRouter(
 
 
 @router.get("", response_model=List[DocumentResponse])
-async def list_documents(current_user: models.User = Depends(deps.get_current_user), db: Session = Depends(deps.get_db)):
+def list_documents(current_user: models.User = Depends(deps.get_current_user), db: Session = Depends(deps.get_db)):
+    """
+    Lists the user's documents, newest first. Declared sync so the blocking query runs in the threadpool, the frontend polls it while ingestion is pending.
+    """
     try:
         documents = db.query(models.Document).filter(models.Document.user_id == current_user.id).order_by(models.Document.created_at.desc()).all()
         return documents
@@ -78,7 +80,8 @@ async def upload_document(file: UploadFile = File(...), current_user: models.Use
     db.refresh(new_doc)
 
     try:
-        s3_repo.upload_file(user_id=user_id, file_stream=file.file, filename=file.filename)
+        # boto3 is blocking, the multipart transfer runs in a worker thread so other requests keep streaming
+        await asyncio.to_thread(s3_repo.upload_file, user_id=user_id, file_stream=file.file, filename=file.filename)
         logger.info(f"Successfully uploaded file to S3 for user {user_id}.")
     except Exception as e:
         logger.error(f"Failed to upload file to S3: {e}", exc_info=True)
@@ -96,19 +99,26 @@ async def upload_document(file: UploadFile = File(...), current_user: models.Use
 @router.delete("/{document_name:path}")
 async def delete_document(document_name: str, current_user: models.User = Depends(deps.get_current_user), db: Session = Depends(deps.get_db)):
     user_id = str(current_user.id)
-    filename = unquote(document_name)
+    # The path parameter is already percent-decoded by the router, decoding it again would mangle names containing '%'
+    filename = document_name
+    documents = db.query(models.Document).filter(models.Document.user_id == current_user.id, models.Document.filename == filename)
+    # Fail fast on unknown names: no S3 round-trip and no full re-index for a document that isn't there
+    if documents.first() is None:
+        raise HTTPException(status_code=404, detail=f"Document '{filename}' not found.")
     s3_repo = S3Repository()
 
     try:
-        s3_repo.delete_file(user_id=user_id, filename=filename)
+        await asyncio.to_thread(s3_repo.delete_file, user_id=user_id, filename=filename)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete file from storage: {e}")
 
-    db.query(models.Document).filter(models.Document.user_id == current_user.id, models.Document.filename == filename).delete()
+    documents.delete()
     db.commit()
 
-    await asyncio.to_thread(process_and_index_documents, user_id=user_id)
-    return {"filename": filename, "status": "deleted_and_reindexed"}
+    # Re-indexing the remaining files can take minutes, it is queued like the post-upload ingestion
+    process_document_task.delay(user_id=user_id)
+    logger.info(f"Re-indexing task for user {user_id} has been queued after deleting {filename}.")
+    return {"filename": filename, "status": "deleted_reindex_queued"}
 
 
 @router.post("/ingest", response_model=IngestionResponse)
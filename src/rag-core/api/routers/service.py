@@ -5,6 +5,7 @@ from fastapi import APIRouter, HTTPException
 
 from core.config import settings as env
 from schemas.service_schemas import ModelInfo, ModelListResponse, RAGConfigResponse
+from utils.utils import get_http_client
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
@@ -39,18 +40,15 @@ async def get_available_models():
     """
     try:
         url = f"{env.LLM_GATEWAY_URL}/model/info"
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-            response.raise_for_status()
-            data = response.json()
+        response = await get_http_client().get(url, timeout=5.0)
+        response.raise_for_status()
+        data = response.json()
 
         available_models = []
         if "data" in data and isinstance(data["data"], list):
-            for model_obj in data["data"]:
-                model_name = model_obj.get("model_name")
-                if model_name and "/" not in model_name:
-                    if not any(m.model_name == model_name for m in available_models):
-                        available_models.append(ModelInfo(model_name=model_name, model_id=model_name))
+            # Ordered unique names in one pass (LiteLLM lists a model once per deployment)
+            model_names = dict.fromkeys(model_obj.get("model_name") for model_obj in data["data"])
+            available_models = [ModelInfo(model_name=name, model_id=name) for name in model_names if name and "/" not in name]
 
         if not available_models:
             logger.warning("Could not parse a list of models from the LLM Gateway response.")
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -12,14 +14,43 @@ class Settings(BaseSettings):
     # --- LLM & Gateway Settings ---
     LLM_GATEWAY_URL: str = "http://llm-gateway:8002"
     LLM_MAX_CONTEXT_TOKENS: int = 30000
+    GATEWAY_MAX_RETRIES: int = 2  # retries of non-streaming gateway calls (query expansion) on 429, 5xx and connection errors
+    GATEWAY_TIMEOUT: float = 30.0  # seconds per attempt of a non-streaming gateway call
+
+    # --- Retrieval ---
+    RETRIEVER_CONCURRENCY: int = 4  # vector searches running at the same time across all requests of a process
+    QUERY_EXPANSION_MIN_CHARS: int = 8  # shorter queries (greetings, "ok", "thanks") skip the expansion LLM call
+    EXPANSION_CACHE_SIZE: int = 10000  # cached query expansions
+    EXPANSION_CACHE_TTL: int = 604800  # seconds (7 days)
+    CHAT_HISTORY_WINDOW: int = 20  # most recent messages loaded for query expansion and the prompt, the token budget still applies on top
 
     # --- Embedding & Reranking Models ---
     RERANKER_MODEL: str = "jinaai/jina-reranker-v2-base-multilingual"
+    RERANKER_BATCH_SIZE: int = 16  # (query, passage) pairs per cross-encoder forward pass
+    RERANKER_THREADS: Optional[int] = None  # ONNX Runtime intra-op threads for the cross-encoder, None = all cores
+    RERANK_MAX_CHARS: int = 1024  # passages are cut to this length before scoring (attention cost grows quadratically)
+    RERANK_TOP_K: int = 8  # best reranked documents kept for the prompt
+    RERANK_CACHE_SIZE: int = 50000  # cached (query, passage) scores
+    RERANK_CACHE_TTL: int = 900  # seconds
+    RERANK_SKIP_MAX_DISTANCE: float = 0.0  # best cosine distance under which a clear retrieval winner skips reranking (and the threshold), 0 = off
+    RERANK_SKIP_MIN_GAP: float = 0.1  # ...provided the runner-up is at least this much further away
     EMBEDDING_MODEL: str = "optimal"
+    EMBEDDING_BATCH_SIZE: int = 256  # texts per ONNX forward pass
     CHUNK_SIZE_P: int = 1500
     CHUNK_OVERLAP_P: int = 200
     CHUNK_SIZE_C: int = 300
     CHUNK_OVERLAP_C: int = 50
+    INGESTION_BATCH_SIZE: int = 256  # pages embedded & inserted per multi-row INSERT
+    INGESTION_QUEUE_SIZE: int = 512  # max loaded pages buffered between the loader thread and the indexer
+    INGESTION_MAX_IN_FLIGHT: int = 2  # batches embedded/inserted concurrently
+    INGESTION_WORKERS: int = 4  # files downloaded & parsed in parallel
+    INGESTION_PARSE_PROCESSES: bool = False  # parse in spawned processes instead of threads, each re-imports rag-core (opt-in, ignored in Celery workers)
+    INGESTION_CACHE_DIR: str = ".ingestion_cache"  # parsed pages keyed by file etag, empty to disable
+    INGESTION_CACHE_MAX_AGE: int = 1209600  # seconds (14 days) an unused parse cache entry is kept
+
+    # --- Semantic Answer Cache ---
+    SEMANTIC_CACHE_ENABLED: bool = False  # answer near-identical past questions without retrieval or LLM calls
+    SEMANTIC_CACHE_THRESHOLD: float = 0.05  # max cosine distance between two questions for a cache hit
 
     # --- Database & Data Storage Settings ---
     DB_HOST: str = "postgres"
@@ -27,6 +58,10 @@ class Settings(BaseSettings):
     DB_NAME: str = "rag_db"
     DB_USER: str = "rag_user"
     DB_PASSWORD: str = "rag_password"
+    DB_POOL_MAX_SIZE: int = 8  # psycopg pool shared by the ingestion repository
+    DB_POOL_SIZE: int = 10  # per SQLAlchemy engine (sync sessions/ingestion, async retrievers)
+    DB_POOL_MAX_OVERFLOW: int = 20
+    DB_POOL_RECYCLE: int = 300  # seconds before a pooled connection is replaced
 
     S3_ENDPOINT_URL: str = "http://minio:9000"
     S3_ACCESS_KEY_ID: str = "minioadmin"
@@ -62,3 +97,13 @@ MODELS_CONFIG = {
     "optimal": {"name": "intfloat/multilingual-e5-base", "source": "Xenova/multilingual-e5-base", "dim": 768, "filename": "onnx/model_quantized.onnx"},
     "quality": {"name": "intfloat/multilingual-e5-large", "source": "Xenova/multilingual-e5-large", "dim": 1024, "filename": "onnx/model_quantized.onnx"},
 }
+
+# int8-quantized ONNX exports of the supported cross-encoders (registered in fastembed under their own names)
+RERANKER_MODELS_CONFIG = {
+    "jina-int8": {
+        "name": "jinaai/jina-reranker-v2-base-multilingual-int8",
+        "source": "jinaai/jina-reranker-v2-base-multilingual",
+        "filename": "onnx/model_quantized.onnx",
+    },
+    "bge-int8": {"name": "BAAI/bge-reranker-base-int8", "source": "Xenova/bge-reranker-base", "filename": "onnx/model_quantized.onnx"},
+}
@@ -1,6 +1,6 @@
 import datetime
 import uuid
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 from pydantic import BaseModel, Field
 
@@ -28,6 +28,7 @@ class LLMRequest(BaseModel):
     api_key: str
     temperature: Optional[float] = Field(default=None, ge=0.0, le=2.0)
     stream: Optional[bool] = None
+    response_format: Optional[Dict[str, str]] = None
 
 
 class ExpandedQueries(BaseModel):
@@ -1,5 +1,5 @@
 import logging
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 from sqlalchemy.orm import Session
 
@@ -58,14 +58,17 @@ def update_user(db: Session, user: models.User, user_update: user_schemas.UserUp
 
 
 # --- History Crud ---
-def get_history_for_user(db: Session, user_id: str) -> List[Dict[str, str]]:
+def get_history_for_user(db: Session, user_id: str, limit: Optional[int] = None) -> List[Dict[str, str]]:
     """
-    Retrieve a user's history.
+    Retrieve a user's history, oldest first. With a limit, only the most recent messages are loaded.
     """
     conversation = db.query(models.Conversation).filter(models.Conversation.user_id == user_id).first()
     if not conversation:
         return []
-    return sorted(conversation.messages, key=lambda msg: msg.created_at)
+    if limit is None:
+        return sorted(conversation.messages, key=lambda msg: msg.created_at)
+    recent = db.query(models.Message).filter(models.Message.conversation_id == conversation.id).order_by(models.Message.created_at.desc()).limit(limit).all()
+    return recent[::-1]
 
 
 def add_message_to_history(db: Session, user_id: str, role: str, content: str, sources: List[Dict] = None) -> models.Message:
@@ -1,10 +1,15 @@
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 from core.config import settings as env
 
-engine = create_engine(env.DB_URL)
+_POOL_KWARGS = dict(pool_size=env.DB_POOL_SIZE, max_overflow=env.DB_POOL_MAX_OVERFLOW, pool_pre_ping=True, pool_recycle=env.DB_POOL_RECYCLE)
+
+engine = create_engine(env.DB_URL, **_POOL_KWARGS)
+# Shared by every async vector store / docstore so requests reuse pooled connections instead of opening an engine each
+async_engine = create_async_engine(env.DB_URL, **_POOL_KWARGS)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
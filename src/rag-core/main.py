@@ -9,7 +9,7 @@ from database.database import create_db_and_tables
 from metrics import update_metrics
 from rag.ingestion_utils import S3Repository
 from rag.retriever import init_components
-from utils.utils import create_service_user
+from utils.utils import close_http_client, create_service_user
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
@@ -48,6 +48,14 @@ async def startup_event():
         logger.error(f"FATAL: RAG initialization failed during startup: {e}", exc_info=True)
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """
+    Release the shared connection pool to the LLM gateway.
+    """
+    await close_http_client()
+
+
 app.include_router(auth.router)
 app.include_router(chat.router)
 app.include_router(documents.router)
@@ -1,20 +1,30 @@
 import logging
+import multiprocessing
 import os
+import pickle
+import queue
 import tempfile
-from typing import Dict, List
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Set
 
 from langchain_classic.retrievers import ParentDocumentRetriever
 from langchain_classic.storage import EncoderBackedStore
 from langchain_classic.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import PyPDFLoader, UnstructuredMarkdownLoader, UnstructuredWordDocumentLoader
+from langchain_community.document_loaders import UnstructuredMarkdownLoader, UnstructuredWordDocumentLoader
+from langchain_community.document_loaders.parsers import PyPDFParser
 from langchain_community.storage import SQLStore
 from langchain_core.documents import Document
+from langchain_core.documents.base import Blob
 from langchain_postgres.vectorstores import PGVector
 
 from core.config import settings as env
 from database import models
-from database.database import SessionLocal
-from utils.utils import value_deserializer, value_serializer
+from database.database import SessionLocal, engine
+from utils.utils import clean_text, content_hash, count_tokens_batch, value_deserializer, value_serializer
 
 from .ingestion_utils import S3Repository, VectorDBRepository, get_embeddings
 
@@ -22,32 +32,242 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(level
 logger = logging.getLogger("Ingestion")
 
 
-def _load_and_process_files(user_id: str, files_to_process: Dict[str, str], s3: S3Repository) -> List[Document]:
-    """Downloads files to temp storage, loads them, and tags them with hashes."""
-    LOADER_MAPPING = {".pdf": PyPDFLoader, ".docx": UnstructuredWordDocumentLoader, ".md": UnstructuredMarkdownLoader}
+_END_OF_STREAM = object()
+# Bump when loaders/parsers change so stale cached parses are ignored
+_PARSE_CACHE_VERSION = 1
 
-    docs = []
-    with tempfile.TemporaryDirectory() as temp_dir:
+
+def _parse_cache_path(etag: str, ext: str) -> Optional[Path]:
+    if not env.INGESTION_CACHE_DIR:
+        return None
+    return Path(env.INGESTION_CACHE_DIR) / f"{etag}{ext}.v{_PARSE_CACHE_VERSION}.pkl"
+
+
+def _read_parse_cache(cache_path: Optional[Path]) -> Optional[List[Document]]:
+    if cache_path is None or not cache_path.exists():
+        return None
+    try:
+        pages = pickle.loads(cache_path.read_bytes())
+        # Refresh the mtime so entries still in use survive age eviction
+        os.utime(cache_path)
+        return pages
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable parse cache entry {cache_path.name}: {e}")
+        return None
+
+
+def _write_parse_cache(cache_path: Optional[Path], pages: List[Document]) -> None:
+    if cache_path is None:
+        return
+    tmp_name = None
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # A unique temp file per writer: concurrent parses of the same etag each publish a complete entry atomically
+        with tempfile.NamedTemporaryFile(dir=cache_path.parent, prefix=f".{cache_path.name}.", suffix=".tmp", delete=False) as tmp:
+            tmp_name = tmp.name
+            pickle.dump(pages, tmp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_name, cache_path)
+    except Exception as e:
+        logger.warning(f"Failed to write parse cache entry {cache_path.name}: {e}")
+        if tmp_name is not None:
+            Path(tmp_name).unlink(missing_ok=True)
+
+
+def _purge_parse_cache(etags: Iterable[str]) -> None:
+    """
+    Drops the cached parses of removed or replaced files, then every entry (or stray temp file) unused for INGESTION_CACHE_MAX_AGE.
+    """
+    if not env.INGESTION_CACHE_DIR:
+        return
+    cache_dir = Path(env.INGESTION_CACHE_DIR)
+    if not cache_dir.is_dir():
+        return
+    for etag in etags:
+        for entry in cache_dir.glob(f"{etag}.*.pkl"):
+            entry.unlink(missing_ok=True)
+    cutoff = time.time() - env.INGESTION_CACHE_MAX_AGE
+    for entry in cache_dir.iterdir():
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                entry.unlink(missing_ok=True)
+        except OSError as e:
+            logger.warning(f"Failed to evict parse cache entry {entry.name}: {e}")
+
+
+# PDFs are parsed from an in-memory buffer; other formats need a file on disk for unstructured.
+_LOADER_MAPPING = {".docx": UnstructuredWordDocumentLoader, ".md": UnstructuredMarkdownLoader}
+_WORKER_S3: Optional[S3Repository] = None
+
+
+def _load_file(user_id: str, filename: str, etag: str, s3: Optional[S3Repository] = None) -> Optional[List[Document]]:
+    """Downloads and parses one file into pages tagged with hashes. Runs in a parser worker, returns None on failure."""
+    global _WORKER_S3
+    if s3 is None:
+        # boto3 clients can't be pickled to worker processes: each builds its own once
+        if _WORKER_S3 is None:
+            _WORKER_S3 = S3Repository()
+        s3 = _WORKER_S3
+
+    ext = os.path.splitext(filename)[1].lower()
+    if ext != ".pdf" and ext not in _LOADER_MAPPING:
+        logger.warning(f"Skipping unsupported file: {filename}")
+        return None
+
+    try:
+        # The S3 etag is a content hash: an unchanged file re-uploaded or re-ingested skips download & parsing
+        cache_path = _parse_cache_path(etag, ext)
+        pages = _read_parse_cache(cache_path)
+        if pages is not None:
+            logger.info(f"Parse cache hit: {filename}")
+        else:
+            logger.info(f"Downloading: {filename}")
+            if ext == ".pdf":
+                pages = list(PyPDFParser().lazy_parse(Blob.from_data(s3.get_file_bytes(user_id, filename), path=filename)))
+            else:
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    local_path = os.path.join(temp_dir, filename.replace("/", "_"))
+                    s3.download_file(user_id, filename, local_path)
+                    pages = _LOADER_MAPPING[ext](local_path).load()
+            _write_parse_cache(cache_path, pages)
+        for page in pages:
+            page.page_content = clean_text(page.page_content)
+            page.metadata["source"] = filename
+            page.metadata["file_hash"] = etag
+        return pages
+    except Exception as e:
+        logger.error(f"Failed to process {filename}: {e}")
+        return None
+
+
+def _iter_loaded_files(user_id: str, files_to_process: Dict[str, str], s3: S3Repository) -> Iterator[List[Document]]:
+    """
+    Parses files in a pool of INGESTION_WORKERS threads and yields their pages in submission order.
+    With INGESTION_PARSE_PROCESSES the pool is made of spawned processes instead: each one re-imports rag-core, so it only
+    pays off for large, CPU-heavy batches from a non-daemonic process (Celery prefork children always stay on threads).
+    At most 2 * workers parsed files are held ahead of the indexer.
+    """
+    workers = max(1, min(env.INGESTION_WORKERS, len(files_to_process)))
+    use_processes = env.INGESTION_PARSE_PROCESSES and workers > 1 and not multiprocessing.current_process().daemon
+    if use_processes:
+        # spawn: forking a process that already runs loader/writer threads is unsafe
+        executor: Executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingestion-parser")
+
+    pending: deque = deque()
+    try:
         for filename, etag in files_to_process.items():
-            ext = os.path.splitext(filename)[1].lower()
-            if ext not in LOADER_MAPPING:
-                logger.warning(f"Skipping unsupported file: {filename}")
-                continue
+            pending.append(executor.submit(_load_file, user_id, filename, etag, None if use_processes else s3))
+            if len(pending) >= 2 * workers and (pages := pending.popleft().result()) is not None:
+                yield pages
+        while pending:
+            if (pages := pending.popleft().result()) is not None:
+                yield pages
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
 
-            local_path = os.path.join(temp_dir, filename.replace("/", "_"))
+
+def _produce_pages(user_id: str, files_to_process: Dict[str, str], s3: S3Repository, pages_queue: queue.Queue, stop: threading.Event) -> None:
+    """Loader thread: pushes loaded pages into the bounded queue, then the end-of-stream marker."""
+
+    def _put(item) -> bool:
+        while not stop.is_set():
             try:
-                logger.info(f"Downloading: {filename}")
-                s3.download_file(user_id, filename, local_path)
-
-                loader = LOADER_MAPPING[ext](local_path)
-                pages = loader.load()
-                for page in pages:
-                    page.metadata["source"] = filename
-                    page.metadata["file_hash"] = etag
-                docs.extend(pages)
-            except Exception as e:
-                logger.error(f"Failed to process {filename}: {e}")
-    return docs
+                pages_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        for pages in _iter_loaded_files(user_id, files_to_process, s3):
+            for page in pages:
+                if not _put(page):
+                    return
+    except Exception as e:
+        logger.error(f"Document loader failed: {e}")
+    finally:
+        _put(_END_OF_STREAM)
+
+
+def _build_ingestion_retriever(user_id: str) -> ParentDocumentRetriever:
+    safe_user_id = user_id.replace("-", "")
+    collection_name = f"user_{safe_user_id}_collection"
+    namespace = f"user_{safe_user_id}_parents"
+
+    vector_store = PGVector(collection_name=collection_name, connection=engine, embeddings=get_embeddings())
+    vector_store.create_tables_if_not_exists()
+    sql_store = SQLStore(engine=engine, namespace=namespace)
+    sql_store.create_schema()
+    store = EncoderBackedStore(sql_store, key_encoder=lambda key: key, value_serializer=value_serializer, value_deserializer=value_deserializer)
+
+    # Parents are split by _index_batch so they can be tagged before being stored
+    return ParentDocumentRetriever(
+        vectorstore=vector_store,
+        docstore=store,
+        child_splitter=RecursiveCharacterTextSplitter(chunk_size=env.CHUNK_SIZE_C, chunk_overlap=env.CHUNK_OVERLAP_C),
+    )
+
+
+_PARENT_SPLITTER = RecursiveCharacterTextSplitter(chunk_size=env.CHUNK_SIZE_P, chunk_overlap=env.CHUNK_OVERLAP_P)
+
+
+def _index_batch(retriever: ParentDocumentRetriever, pages: List[Document]) -> int:
+    parents = _PARENT_SPLITTER.split_documents(pages)
+    token_counts = count_tokens_batch([parent.page_content for parent in parents])
+    for parent, n_tokens in zip(parents, token_counts):
+        # Lets retrieval dedup and the rerank score cache key parents without hashing their text per query
+        parent.metadata["_content_hash"] = content_hash(parent.page_content)
+        # Read by the prompt builder's context budget instead of re-tokenizing every retrieved parent
+        parent.metadata["_n_tokens"] = n_tokens
+    retriever.add_documents(parents, ids=None, add_to_docstore=True)
+    return len(pages)
+
+
+def _index_files(user_id: str, files_to_process: Dict[str, str], s3: S3Repository) -> int:
+    """
+    Loader -> indexer pipeline: a loader thread downloads and parses files into a bounded queue
+    while this thread groups pages into batches handed to a small writer pool, so parsing, embedding
+    and DB writes overlap. At most INGESTION_MAX_IN_FLIGHT batches are embedded/inserted at once and
+    peak memory stays around INGESTION_QUEUE_SIZE + (INGESTION_MAX_IN_FLIGHT + 1) * INGESTION_BATCH_SIZE pages.
+    Returns the number of indexed pages.
+    """
+    retriever = _build_ingestion_retriever(user_id)
+    pages_queue: queue.Queue = queue.Queue(maxsize=env.INGESTION_QUEUE_SIZE)
+    stop = threading.Event()
+    loader = threading.Thread(target=_produce_pages, args=(user_id, files_to_process, s3, pages_queue, stop), name="ingestion-loader", daemon=True)
+    loader.start()
+
+    indexed = 0
+    in_flight: Set[Future] = set()
+    try:
+        with ThreadPoolExecutor(max_workers=env.INGESTION_MAX_IN_FLIGHT, thread_name_prefix="ingestion-writer") as writers:
+
+            def _submit(pages: List[Document]) -> None:
+                nonlocal indexed
+                if len(in_flight) >= env.INGESTION_MAX_IN_FLIGHT:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    in_flight.difference_update(done)
+                    indexed += sum(future.result() for future in done)
+                in_flight.add(writers.submit(_index_batch, retriever, pages))
+
+            batch: List[Document] = []
+            while (page := pages_queue.get()) is not _END_OF_STREAM:
+                batch.append(page)
+                if len(batch) >= env.INGESTION_BATCH_SIZE:
+                    _submit(batch)
+                    batch = []
+            if batch:
+                _submit(batch)
+            indexed += sum(future.result() for future in wait(in_flight).done)
+    finally:
+        stop.set()
+        for future in in_flight:
+            future.cancel()
+        loader.join()
+
+    logger.info(f"Indexed {indexed} pages via PDR for user {user_id}.")
+    return indexed
 
 
 def process_and_index_documents(user_id: str) -> int:
@@ -75,6 +295,9 @@ def process_and_index_documents(user_id: str) -> int:
     if files_to_remove_from_index:
         logger.info(f"Removing {len(files_to_remove_from_index)} obsolete/modified documents from index...")
         db.delete_documents_by_source(list(files_to_remove_from_index))
+    if files_to_remove_from_index or files_to_process:
+        db.clear_answer_cache()
+    _purge_parse_cache(indexed_files[filename] for filename in files_to_remove_from_index)
 
     db_session = SessionLocal()
     try:
@@ -86,27 +309,7 @@ def process_and_index_documents(user_id: str) -> int:
             db_session.commit()
 
             try:
-                new_docs = _load_and_process_files(user_id, files_to_process, s3)
-
-                if new_docs:
-                    logger.info(f"Indexing {len(new_docs)} pages via PDR for user {user_id}...")
-                    safe_user_id = user_id.replace("-", "")
-                    collection_name = f"user_{safe_user_id}_collection"
-                    namespace = f"user_{safe_user_id}_parents"
-
-                    vector_store = PGVector(collection_name=collection_name, connection=env.DB_URL, embeddings=get_embeddings())
-                    vector_store.create_tables_if_not_exists()
-                    sql_store = SQLStore(db_url=env.DB_URL, namespace=namespace)
-                    sql_store.create_schema()
-                    store = EncoderBackedStore(sql_store, key_encoder=lambda key: key, value_serializer=value_serializer, value_deserializer=value_deserializer)
-
-                    retriever = ParentDocumentRetriever(
-                        vectorstore=vector_store,
-                        docstore=store,
-                        child_splitter=RecursiveCharacterTextSplitter(chunk_size=env.CHUNK_SIZE_C, chunk_overlap=env.CHUNK_OVERLAP_C),
-                        parent_splitter=RecursiveCharacterTextSplitter(chunk_size=env.CHUNK_SIZE_P, chunk_overlap=env.CHUNK_OVERLAP_P),
-                    )
-                    retriever.add_documents(new_docs, ids=None, add_to_docstore=True)
+                _index_files(user_id, files_to_process, s3)
 
                 db_session.query(models.Document).filter(models.Document.user_id == user_id, models.Document.filename.in_(files_to_process.keys())).update(
                     {"status": "completed"}, synchronize_session=False
@@ -115,6 +318,12 @@ def process_and_index_documents(user_id: str) -> int:
 
             except Exception as e:
                 logger.error(f"Failed to process documents: {e}")
+                # Batches commit separately: drop what was already written, otherwise the matching file_hash makes
+                # later syncs treat these files as indexed and they stay half-indexed
+                try:
+                    db.delete_documents_by_source(list(files_to_process))
+                except Exception as cleanup_error:
+                    logger.error(f"Failed to remove partially indexed documents: {cleanup_error}")
                 db_session.query(models.Document).filter(models.Document.user_id == user_id, models.Document.filename.in_(files_to_process.keys())).update(
                     {"status": "failed", "error_message": str(e)}, synchronize_session=False
                 )
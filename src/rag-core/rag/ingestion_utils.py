@@ -1,4 +1,5 @@
 import logging
+import threading
 from typing import Dict, List, Optional
 
 import boto3
@@ -8,6 +9,7 @@ from fastembed import TextEmbedding
 from fastembed.common.model_description import ModelSource, PoolingType
 from langchain_community.embeddings import FastEmbedEmbeddings
 from langchain_core.embeddings import Embeddings
+from psycopg_pool import ConnectionPool
 
 from core.config import MODELS_CONFIG
 from core.config import settings as env
@@ -32,19 +34,52 @@ def configure_embedding_model(user_choice: str):
     return config["name"]
 
 
+class LengthSortedFastEmbedEmbeddings(FastEmbedEmbeddings):
+    """Embeds texts sorted by length so each ONNX batch pads to similar lengths, then restores input order."""
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = super().embed_documents([texts[i] for i in order])
+        embeddings: List[List[float]] = [[]] * len(texts)
+        for i, vector in zip(order, vectors):
+            embeddings[i] = vector
+        return embeddings
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Embeds several queries in one batched pass, the same way embed_query does for one."""
+        return [vector.tolist() for vector in self._model.query_embed(texts, batch_size=self.batch_size)]
+
+
 _EMBEDDER: Optional[Embeddings] = None
+_EMBEDDER_LOCK = threading.Lock()
 
 
 def get_embeddings() -> Embeddings:
-    """Lazy singleton to load the embedding model only once."""
+    """Lazy singleton to load the embedding model only once, shared by ingestion and retrieval."""
     global _EMBEDDER
     if _EMBEDDER is None:
-        emb_model = configure_embedding_model(env.EMBEDDING_MODEL)
-        logger.info(f"Initializing embeddings model ({emb_model})...")
-        _EMBEDDER = FastEmbedEmbeddings(model_name=emb_model)
+        with _EMBEDDER_LOCK:
+            if _EMBEDDER is None:
+                emb_model = configure_embedding_model(env.EMBEDDING_MODEL)
+                logger.info(f"Initializing embeddings model ({emb_model})...")
+                _EMBEDDER = LengthSortedFastEmbedEmbeddings(model_name=emb_model, batch_size=env.EMBEDDING_BATCH_SIZE)
     return _EMBEDDER
 
 
+_DB_POOL: Optional[ConnectionPool] = None
+_DB_POOL_LOCK = threading.Lock()
+
+
+def get_db_pool() -> ConnectionPool:
+    """Lazy singleton: one psycopg connection pool per process, reused across ingestion runs."""
+    global _DB_POOL
+    if _DB_POOL is None:
+        with _DB_POOL_LOCK:
+            if _DB_POOL is None:
+                _DB_POOL = ConnectionPool(env.DB_URL.replace("+psycopg", ""), min_size=1, max_size=env.DB_POOL_MAX_SIZE, open=True, name="ingestion")
+    return _DB_POOL
+
+
 class S3Repository:
     """Abstration layer for S3 operations."""
 
@@ -91,6 +126,10 @@ class S3Repository:
         full_key = f"{user_id}/{key}"
         self.client.download_file(self.bucket, full_key, dest_path)
 
+    def get_file_bytes(self, user_id: str, key: str) -> bytes:
+        full_key = f"{user_id}/{key}"
+        return self.client.get_object(Bucket=self.bucket, Key=full_key)["Body"].read()
+
     def upload_file(self, user_id: str, file_stream, filename: str):
         full_key = f"{user_id}/{filename}"
         self.client.upload_fileobj(file_stream, self.bucket, full_key)
@@ -116,15 +155,15 @@ class VectorDBRepository:
         if not user_id:
             raise ValueError("user_id cannot be empty")
         self.user_id = user_id
-        self.db_url = env.DB_URL.replace("+psycopg", "")
         self.collection = f"user_{user_id.replace("-", "")}_collection"
         self.docstore_namespace = f"user_{user_id.replace("-", "")}_parents"
+        self.answer_cache_collection = f"user_{user_id.replace("-", "")}_answer_cache"
 
     def _get_conn(self):
-        return psycopg.connect(self.db_url, autocommit=False)
+        return get_db_pool().connection()
 
     def ensure_schema(self) -> None:
-        """Creates vector extension and kv-store table if missing."""
+        """Creates vector extension, kv-store table and embedding lookup index if missing."""
         try:
             with self._get_conn() as conn, conn.cursor() as cur:
                 # cur.execute("CREATE EXTENSION IF NOT EXISTS vector;") # Managed by init script
@@ -136,6 +175,15 @@ class VectorDBRepository:
                     );
                 """
                 )
+                # Lets the per-file (source, hash) listing and delete-by-source lookups use an index scan
+                cur.execute("SELECT to_regclass('public.langchain_pg_embedding');")
+                if cur.fetchone()[0]:
+                    cur.execute(
+                        """
+                        CREATE INDEX IF NOT EXISTS ix_lpe_collection_source_hash
+                        ON langchain_pg_embedding (collection_id, (cmetadata ->> 'source'), (cmetadata ->> 'file_hash'));
+                    """
+                    )
                 conn.commit()
         except psycopg.Error as e:
             logger.error(f"DB Init failed: {e}")
@@ -149,11 +197,13 @@ class VectorDBRepository:
         try:
             with self._get_conn() as conn, conn.cursor() as cur:
                 query = """
-                SELECT DISTINCT cmetadata ->> 'source' as file_source, cmetadata ->> 'file_hash' as file_hash
-                FROM langchain_pg_embedding
-                WHERE collection_id = (SELECT uuid FROM langchain_pg_collection WHERE name = %s);
+                SELECT e.cmetadata ->> 'source' as file_source, e.cmetadata ->> 'file_hash' as file_hash
+                FROM langchain_pg_embedding e
+                JOIN langchain_pg_collection c ON c.uuid = e.collection_id
+                WHERE c.name = %s
+                GROUP BY e.collection_id, file_source, file_hash;
                 """
-                cur.execute(query, (self.collection,))
+                cur.execute(query, (self.collection,), prepare=True)
                 for row in cur.fetchall():
                     if row[0] and row[1]:
                         indexed_files[row[0]] = row[1]
@@ -168,43 +218,50 @@ class VectorDBRepository:
         if not source_keys:
             return
 
-        q_find_ids = """
-            SELECT DISTINCT cmetadata ->> 'doc_id' FROM langchain_pg_embedding
-            WHERE collection_id = (SELECT uuid FROM langchain_pg_collection WHERE name = %s)
-            AND cmetadata ->> 'source' = ANY(%s);
-        """
-
-        q_del_vecs = """
-            DELETE FROM langchain_pg_embedding
-            WHERE collection_id = (SELECT uuid FROM langchain_pg_collection WHERE name = %s)
-            AND cmetadata ->> 'doc_id' = ANY(%s);
-        """
-
-        q_del_store = """
-            DELETE FROM langchain_key_value_stores
-            WHERE namespace = %s AND key = ANY(%s);
+        # Single set-based statement: children are removed by source and their parent ids feed the docstore delete
+        q_delete = """
+            WITH deleted_children AS (
+                DELETE FROM langchain_pg_embedding
+                WHERE collection_id = (SELECT uuid FROM langchain_pg_collection WHERE name = %s)
+                AND cmetadata ->> 'source' = ANY(%s)
+                RETURNING cmetadata ->> 'doc_id' AS doc_id
+            ), deleted_parents AS (
+                DELETE FROM langchain_key_value_stores
+                WHERE namespace = %s AND key IN (SELECT doc_id FROM deleted_children)
+                RETURNING key
+            )
+            SELECT (SELECT count(*) FROM deleted_children), (SELECT count(*) FROM deleted_parents);
         """
 
         try:
             with self._get_conn() as conn, conn.cursor() as cur:
-                cur.execute(q_find_ids, (self.collection, source_keys))
-                parent_ids = [row[0] for row in cur.fetchall()]
-                if parent_ids:
-                    cur.execute(q_del_vecs, (self.collection, parent_ids))
-                    cur.execute(q_del_store, (self.docstore_namespace, parent_ids))
-                    logger.info(f"Deleted {len(parent_ids)} documents (Parents & Children) associated with {len(source_keys)} source files.")
+                cur.execute(q_delete, (self.collection, source_keys, self.docstore_namespace), prepare=True)
+                children, parents = cur.fetchone()
+                if children or parents:
+                    logger.info(f"Deleted {parents} parents and {children} children associated with {len(source_keys)} source files.")
                 conn.commit()
         except psycopg.Error as e:
+            # The pool rolls the transaction back when the connection block exits on error
             logger.error(f"Delete transaction failed: {e}")
-            conn.rollback()
             raise
 
+    def clear_answer_cache(self) -> None:
+        """Drops the user's cached answers, which may cite documents that just changed."""
+        q = "DELETE FROM langchain_pg_embedding WHERE collection_id = (SELECT uuid FROM langchain_pg_collection WHERE name = %s);"
+        try:
+            with self._get_conn() as conn, conn.cursor() as cur:
+                cur.execute(q, (self.answer_cache_collection,), prepare=True)
+                if cur.rowcount:
+                    logger.info(f"Invalidated {cur.rowcount} cached answers.")
+        except psycopg.Error as e:
+            logger.error(f"Failed to invalidate answer cache: {e}")
+
     def count_chunks(self) -> int:
         """Returns total count of vector chunks."""
         q = "SELECT COUNT(*) FROM langchain_pg_embedding WHERE collection_id = (SELECT uuid FROM langchain_pg_collection WHERE name = %s);"
         try:
             with self._get_conn() as conn, conn.cursor() as cur:
-                cur.execute(q, (self.collection,))
+                cur.execute(q, (self.collection,), prepare=True)
                 res = cur.fetchone()
                 return res[0] if res else 0
         except (psycopg.errors.UndefinedTable, psycopg.Error):
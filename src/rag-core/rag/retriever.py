@@ -1,25 +1,26 @@
-import json
+import asyncio
 import logging
-from typing import AsyncGenerator, Optional
+import threading
+from dataclasses import dataclass, field
+from typing import AsyncGenerator, Dict, Optional
 
+import orjson
+from fastembed.common.model_description import ModelSource
 from fastembed.rerank.cross_encoder import TextCrossEncoder
 from langchain_classic.retrievers import ParentDocumentRetriever
 from langchain_classic.storage import EncoderBackedStore
 from langchain_classic.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.storage import SQLStore
-from langchain_core.output_parsers import PydanticOutputParser
-from langchain_core.prompts import PromptTemplate
-from langchain_core.runnables import RunnableSequence
-from langchain_openai import ChatOpenAI
 from langchain_postgres.vectorstores import PGVector
 from sqlalchemy.orm import Session
 
 from core import security
+from core.config import RERANKER_MODELS_CONFIG
 from core.config import settings as env
-from core.models import ExpandedQueries
 from database import crud
+from database.database import async_engine
 from metrics import RAG_RETRIEVAL_LATENCY, RAG_RETRIEVED_DOCS
-from utils.utils import get_context_window, value_deserializer, value_serializer
+from utils.utils import count_history_tokens, get_context_window, value_deserializer, value_serializer
 
 from . import retriever_utils
 from .ingestion import get_embeddings
@@ -29,45 +30,79 @@ logger = logging.getLogger(__name__)
 
 
 # --- Init & Component Getters ---
-QUERY_EXP_PROMPTS = retriever_utils.load_prompts("prompts/query_expansion.yaml")
 
 
-_RERANKER: Optional[TextCrossEncoder] = None
+@dataclass
+class _Components:
+    """
+    Process-wide singletons, populated once and then read directly on the request path.
+    """
+
+    reranker: Optional[TextCrossEncoder] = None
+    retrievers: Dict[str, ParentDocumentRetriever] = field(default_factory=dict)
+    answer_caches: Dict[str, PGVector] = field(default_factory=dict)
+    # Coalesce concurrent cold-start builds (model load, schema/collection creation) into one
+    reranker_lock: threading.Lock = field(default_factory=threading.Lock)
+    build_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+
+_C = _Components()
+
+
+def configure_reranker_model(user_choice: str) -> str:
+    """
+    Resolves a reranker alias to its int8 ONNX export, registering it in fastembed; other names are used as-is.
+    """
+    if user_choice not in RERANKER_MODELS_CONFIG:
+        return user_choice
+
+    config = RERANKER_MODELS_CONFIG[user_choice]
+    logger.info(f"Reranker config: '{user_choice}' -> {config['name']} ({config['filename']})")
+    TextCrossEncoder.add_custom_model(model=config["name"], sources=ModelSource(hf=config["source"]), model_file=config["filename"])
+    return config["name"]
 
 
 def init_components():
     """
     Initialize heavy components (Embedder, Reranker, LLM).
     """
-    global _RERANKER
     logger.info("Initializing Embedder, Reranker and LLM...")
 
     get_embeddings()
 
-    if _RERANKER is None:
-        logger.info(f"Initializing reranker model... ({env.RERANKER_MODEL})")
-        _RERANKER = TextCrossEncoder(model_name=env.RERANKER_MODEL)
-        logger.info("Reranker model loaded.")
+    if _C.reranker is None:
+        with _C.reranker_lock:
+            if _C.reranker is None:
+                rerank_model = configure_reranker_model(env.RERANKER_MODEL)
+                logger.info(f"Initializing reranker model... ({rerank_model})")
+                _C.reranker = TextCrossEncoder(model_name=rerank_model, threads=env.RERANKER_THREADS)
+                logger.info("Reranker model loaded.")
 
     logger.info("Embedder, Reranker and LLM chain initialized.")
 
 
-def get_reranker() -> Optional[TextCrossEncoder]:
-    return _RERANKER
-
-
 async def get_retriever_for_user(user_id: str) -> ParentDocumentRetriever:
     """
-    Build or refresh the ParentDocumentRetriever.
+    Get the user's ParentDocumentRetriever, built once per process on the shared async engine.
     """
+    if user_id in _C.retrievers:
+        return _C.retrievers[user_id]
+
+    async with _C.build_lock:
+        if user_id not in _C.retrievers:
+            _C.retrievers[user_id] = await _build_retriever(user_id)
+    return _C.retrievers[user_id]
+
+
+async def _build_retriever(user_id: str) -> ParentDocumentRetriever:
     logger.info(f"Building Parent Document Retriever for user {user_id}...")
-    user_id = user_id.replace("-", "")
-    collection_name = f"user_{user_id}_collection"
-    namespace = f"user_{user_id}_parents"
+    safe_user_id = user_id.replace("-", "")
+    collection_name = f"user_{safe_user_id}_collection"
+    namespace = f"user_{safe_user_id}_parents"
 
     embedder = get_embeddings()
-    vector_store = PGVector(collection_name=collection_name, connection=env.DB_URL, embeddings=embedder, async_mode=True)
-    doc_store = SQLStore(db_url=env.DB_URL, namespace=namespace, async_mode=True)
+    vector_store = PGVector(collection_name=collection_name, connection=async_engine, embeddings=embedder, async_mode=True)
+    doc_store = SQLStore(engine=async_engine, namespace=namespace, async_mode=True)
     await doc_store.acreate_schema()
     # await vector_store.acreate_vector_extension() # Managed init script
     await vector_store.acreate_collection()
@@ -81,30 +116,21 @@ async def get_retriever_for_user(user_id: str) -> ParentDocumentRetriever:
     return retriever
 
 
-def get_llm_query_gen(model: str, api_key: str) -> Optional[ChatOpenAI]:
-    """
-    Gets the non-streaming LLM instance for internal tasks like query generation.
-    """
-    return ChatOpenAI(model_name=model, openai_api_base=env.LLM_GATEWAY_URL, openai_api_key=api_key, temperature=0.0, streaming=False)
-
-
-def get_query_expansion_chain(model: str, api_key: str) -> Optional[RunnableSequence]:
+async def get_answer_cache_for_user(user_id: str) -> PGVector:
     """
-    Get the query expansion chain.
+    Per-user collection of past (question, answer) pairs, embedded with the shared model.
     """
-    llm = get_llm_query_gen(model, api_key)
-    if not llm:
-        logger.error("Cannot initialize query expansion chain without LLM.")
-        return None
-
-    output_parser = PydanticOutputParser(pydantic_object=ExpandedQueries)
-    prompt = PromptTemplate(
-        template=QUERY_EXP_PROMPTS["instructions"],
-        input_variables=["question", "chat_history"],
-        partial_variables={"format_instructions": output_parser.get_format_instructions()},
-    )
+    if user_id in _C.answer_caches:
+        return _C.answer_caches[user_id]
 
-    return prompt | llm | output_parser
+    async with _C.build_lock:
+        if user_id not in _C.answer_caches:
+            collection_name = f"user_{user_id.replace('-', '')}_answer_cache"
+            cache_store = PGVector(collection_name=collection_name, connection=async_engine, embeddings=get_embeddings(), async_mode=True)
+            await cache_store.acreate_tables_if_not_exists()
+            await cache_store.acreate_collection()
+            _C.answer_caches[user_id] = cache_store
+    return _C.answer_caches[user_id]
 
 
 # --- RAG flow ---
@@ -112,7 +138,7 @@ def get_query_expansion_chain(model: str, api_key: str) -> Optional[RunnableSequ
 
 async def orchestrate_rag_flow(
     query: str, user_id: str, db: Session, temp: float = 0.2, strict_mode: bool = True, rerank_threshold: float = 0.0
-) -> AsyncGenerator[str, None]:
+) -> AsyncGenerator[bytes, None]:
     """
     Executes the entire RAG flow by orchestrating calls to specialized functions.
 
@@ -121,57 +147,88 @@ async def orchestrate_rag_flow(
         history: The chat history.
 
     Yields:
-        A stream of JSON strings containing the LLM's answer or an error.
+        SSE frames (as bytes) containing the sources and the LLM's answer, or a JSON error line.
     """
     user = crud.get_user_by_id(db, user_id=user_id)
     user_api_key = security.decrypt_data(user.encrypted_api_key if user.encrypted_api_key else None)
     user_side_api_key = security.decrypt_data(user.encrypted_side_api_key if user.encrypted_side_api_key else None)
     user_llm_model = user.llm_model
     user_llm_side_model = user.llm_side_model
-    window_size = await get_context_window(user.llm_model)
 
     logger.info(f"Starting RAG flow for query: {query[:50]}... (strict mode: {strict_mode}))")
 
     crud.add_message_to_history(db, user_id=user_id, role="user", content=query)
-    db_history = crud.get_history_for_user(db, user_id=user_id)
+
+    db_history = crud.get_history_for_user(db, user_id=user_id, limit=env.CHAT_HISTORY_WINDOW)
     history = [{"role": msg.role, "content": msg.content} for msg in db_history]
 
-    retriever = await get_retriever_for_user(user_id)
-    if retriever is None:
-        logger.error("Cannot retrieve retriever.")
-        yield json.dumps({"type": "error", "content": "System Error: Retriever not available."}) + "\n"
+    # Paraphrased repeats skip query expansion, retrieval, reranking and generation entirely.
+    # Keyed on the model and the prior turns (the last history message is this query) so follow-ups are never shared
+    answer_cache = await get_answer_cache_for_user(user_id) if env.SEMANTIC_CACHE_ENABLED else None
+    cache_filter = retriever_utils.answer_cache_filter(strict_mode, user_llm_model, history[:-1]) if answer_cache is not None else {}
+    cached = await retriever_utils.lookup_cached_answer(answer_cache, query, cache_filter)
+    if cached:
+        cached_answer, source_chunks = cached
+        yield b"data: " + orjson.dumps({"type": "sources", "data": source_chunks}) + b"\n\n"
+        yield b"data: " + orjson.dumps({"choices": [{"delta": {"content": cached_answer}}]}) + b"\n\n"
+        yield b"data: [DONE]\n\n"
+        crud.add_message_to_history(db, user_id=user_id, role="assistant", content=cached_answer, sources=source_chunks)
+        logger.info("RAG flow finished (served from semantic cache).")
         return
-    reranker = get_reranker()
-    query_expansion_chain = get_query_expansion_chain(model=user_llm_side_model, api_key=user_side_api_key)
 
-    with RAG_RETRIEVAL_LATENCY.time():
-        expanded_queries = await retriever_utils.expand_query(query, history, query_expansion_chain)
-        retrieved_docs = await retriever_utils.retrieve_and_deduplicate_documents(retriever, expanded_queries)
-        final_docs = retriever_utils.rerank_documents(query, retrieved_docs, reranker, rerank_threshold)
-
-    RAG_RETRIEVED_DOCS.observe(len(final_docs))
-
-    messages, token_count, source_chunks = retriever_utils.build_final_prompt(query, history, final_docs, strict_mode, window_size)
+    # The model info lookup runs while documents are retrieved, it's only needed for the prompt budget
+    window_size_task = asyncio.create_task(get_context_window(user.llm_model))
+    # Tokenize the history in a worker thread while query expansion and retrieval are awaiting I/O
+    history_tokens_task = asyncio.create_task(asyncio.to_thread(count_history_tokens, history))
+
+    try:
+        retriever = await get_retriever_for_user(user_id)
+        if retriever is None:
+            logger.error("Cannot retrieve retriever.")
+            yield orjson.dumps({"type": "error", "content": "System Error: Retriever not available."}) + b"\n"
+            return
+        reranker = _C.reranker
+
+        with RAG_RETRIEVAL_LATENCY.time():
+            final_docs = await retriever_utils.retrieve_and_rerank_documents(
+                query, history, retriever, user_llm_side_model, user_side_api_key, reranker, rerank_threshold
+            )
+
+        RAG_RETRIEVED_DOCS.observe(len(final_docs))
+
+        window_size = await window_size_task
+        history_token_counts = await history_tokens_task
+    finally:
+        # Retrieval failures and client disconnects (GeneratorExit) must not leave the side tasks running unobserved
+        for task in (window_size_task, history_tokens_task):
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()
+
+    messages, token_count, source_chunks = await asyncio.to_thread(
+        retriever_utils.build_final_prompt, query, history, final_docs, strict_mode, window_size, history_token_counts
+    )
 
     # We do this because evaluation-runner needs the context texts and metadatas
     sources_payload = {"type": "sources", "data": source_chunks}
-    yield f"data: {json.dumps(sources_payload)}\n\n"
+    yield b"data: " + orjson.dumps(sources_payload) + b"\n\n"
 
-    full_assistant_response = ""
-    async for chunk in retriever_utils.stream_llm_response(messages, token_count, temp, model=user_llm_model, api_key=user_api_key):
+    answer_parts = []
+    async for line in retriever_utils.stream_llm_response(messages, token_count, temp, model=user_llm_model, api_key=user_api_key):
         try:
-            # logger.info(f"Chunk: {chunk}")
-            if chunk.startswith("data:"):
-                data_str = chunk[5:].strip()
-                if data_str and data_str != "[DONE]":
-                    data = json.loads(data_str)
-                    content = data.get("choices", [{}])[0].get("delta", {}).get("content", "")
+            if line.startswith(b"data:"):
+                data_str = line[5:].strip()
+                if data_str and data_str != b"[DONE]":
+                    content = orjson.loads(data_str)["choices"][0]["delta"]["content"]
                     if content:
-                        full_assistant_response += content
-        except json.JSONDecodeError:
+                        answer_parts.append(content)
+        except (orjson.JSONDecodeError, KeyError, IndexError, TypeError):
             pass
-        yield chunk
+        yield line
 
+    full_assistant_response = "".join(answer_parts)
     if full_assistant_response:
         crud.add_message_to_history(db, user_id=user_id, role="assistant", content=full_assistant_response, sources=source_chunks)
+        await retriever_utils.store_cached_answer(answer_cache, query, cache_filter, full_assistant_response, source_chunks)
     logger.info("RAG flow finished.")
@@ -1,17 +1,34 @@
 import asyncio
-import json
+import heapq
 import logging
-from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+import re
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from typing import Any, AsyncGenerator, Dict, List, Optional, Set, Tuple
 
 import httpx
+import orjson
 import yaml
 from fastembed.rerank.cross_encoder import TextCrossEncoder
 from langchain_classic.retrievers import ParentDocumentRetriever
-from langchain_core.runnables import RunnableSequence
+from langchain_core.documents import Document
+from langchain_postgres.vectorstores import PGVector
+from sqlalchemy import text
 
 from core.config import settings as env
-from core.models import LLMRequest
-from utils.utils import count_tokens, format_history_for_prompt, truncate_history
+from core.models import ExpandedQueries, LLMRequest
+from database.database import async_engine
+from utils.utils import (
+    TTLCache,
+    clean_text,
+    content_hash,
+    count_tokens,
+    count_tokens_batch,
+    format_history_for_prompt,
+    open_stream_with_retry,
+    post_with_retry,
+    truncate_history,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -28,161 +45,412 @@ def load_prompts(file_path: str) -> dict:
 
 
 SYSTEM_PROMPTS = load_prompts("prompts/system.yaml")
+QUERY_EXP_PROMPTS = load_prompts("prompts/query_expansion.yaml")
+LITERAL_FILENAME_RE = re.compile(r"^\S+\.(pdf|md|txt|docx)$", re.IGNORECASE)
+QUERY_EXP_FORMAT_INSTRUCTIONS = 'Answer with a JSON object of the form {"queries": ["first query", "second query"]} and nothing else.'
+MAX_DOCS_TO_RERANK = 15
+# One long-lived thread owns cross-encoder inference: no per-call thread handoff, and concurrent requests
+# queue up instead of oversubscribing the cores ONNX Runtime already parallelizes over (RERANKER_THREADS)
+RERANK_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rerank")
+# (side model, normalized query, history fingerprint) -> expanded queries
+EXPANSION_CACHE = TTLCache(maxsize=env.EXPANSION_CACHE_SIZE, ttl=env.EXPANSION_CACHE_TTL)
+# Vector searches in flight across all requests of the process, so bursts queue here instead of exhausting the DB pool
+RETRIEVAL_SEMAPHORE = asyncio.Semaphore(env.RETRIEVER_CONCURRENCY)
+# (query, passage) fingerprints -> cross-encoder score, repeated questions skip the model
+RERANK_SCORE_CACHE = TTLCache(maxsize=env.RERANK_CACHE_SIZE, ttl=env.RERANK_CACHE_TTL)
+# The system message only depends on the strict mode: both variants are formatted once at import
+SYSTEM_INSTRUCTIONS = {
+    True: SYSTEM_PROMPTS.get("instructions", "").replace("{strict_rule}", SYSTEM_PROMPTS.get("strict_rule_true", "")),
+    False: SYSTEM_PROMPTS.get("instructions", "").replace("{strict_rule}", SYSTEM_PROMPTS.get("strict_rule_false", "")),
+}
+SYSTEM_INSTRUCTIONS_TOKENS = {strict: count_tokens(instructions) for strict, instructions in SYSTEM_INSTRUCTIONS.items()}
+# User message frame split around its placeholders, so each query is a plain concatenation
+_USER_PREFIX, _, _USER_REST = SYSTEM_PROMPTS.get("user_message", "{context}{question}").partition("{context}")
+_USER_MIDDLE, _, _USER_SUFFIX = _USER_REST.partition("{question}")
+# Fixed part of the prompt (system message + user message frame), counted once per strict mode instead of per query
+SYSTEM_PROMPT_FIXED_TOKENS = {strict: tokens + count_tokens(_USER_PREFIX + _USER_MIDDLE + _USER_SUFFIX) for strict, tokens in SYSTEM_INSTRUCTIONS_TOKENS.items()}
+
+
+def answer_cache_filter(strict: bool, model: Optional[str], history: List[Dict[str, str]]) -> Dict[str, Any]:
+    """
+    Metadata an answer is cached under: the same question only gets the same answer within the same mode, from the same
+    model and after the same prior turns (follow-ups like "and the second one?" depend on the conversation).
+    """
+    return {"strict": strict, "model": model or "", "history": content_hash(format_history_for_prompt(history)[:4000])}
+
+
+async def lookup_cached_answer(cache_store: Optional[PGVector], query: str, cache_filter: Dict[str, Any]) -> Optional[Tuple[str, List[Dict[str, Any]]]]:
+    """
+    Looks up the answer given to a previous, semantically equivalent question.
 
+    Args:
+        cache_store: The user's answer cache collection (None when the cache is disabled).
+        query: The user's query.
+        cache_filter: Metadata from answer_cache_filter, answers are only shared between identical contexts.
 
-async def expand_query(query: str, history: List[Dict[str, str]], query_expansion_chain: Optional[RunnableSequence]) -> List[str]:
+    Returns:
+        The cached answer and its source chunks, or None on a miss.
+    """
+    if cache_store is None:
+        return None
+
+    try:
+        hits = await cache_store.asimilarity_search_with_score(query, k=1, filter=cache_filter)
+    except Exception as e:
+        logger.warning(f"Semantic cache lookup failed: {e}")
+        return None
+
+    if not hits or hits[0][1] > env.SEMANTIC_CACHE_THRESHOLD:
+        return None
+    cached_doc, distance = hits[0]
+    logger.info(f"Semantic cache hit (distance: {distance:.4f}) for query: {query[:50]}...")
+    return cached_doc.metadata.get("answer", ""), cached_doc.metadata.get("sources", [])
+
+
+async def store_cached_answer(cache_store: Optional[PGVector], query: str, cache_filter: Dict[str, Any], answer: str, sources: List[Dict[str, Any]]) -> None:
+    """
+    Stores a streamed answer so paraphrased repeats of the question can be served from the cache.
+    """
+    if cache_store is None or not answer:
+        return
+
+    try:
+        await cache_store.aadd_documents([Document(page_content=query, metadata={**cache_filter, "answer": answer, "sources": sources})])
+    except Exception as e:
+        logger.warning(f"Failed to store answer in semantic cache: {e}")
+
+
+def is_literal_query(query: str) -> bool:
+    """
+    Quoted phrases, one or two word lookups and bare filenames are searched as typed: rephrasing them adds nothing.
+    """
+    stripped = query.strip()
+    return (len(stripped) > 1 and stripped[0] == stripped[-1] == '"') or len(stripped.split()) <= 2 or LITERAL_FILENAME_RE.match(stripped) is not None
+
+
+async def expand_query(query: str, history: List[Dict[str, str]], model: Optional[str], api_key: Optional[str]) -> List[str]:
     """
     Expands the original query into multiple related queries using a language model.
+    One JSON-mode completion through the gateway, on the shared HTTP client.
 
     Args:
         query: The user's original query.
         history: The chat history.
-        query_expansion_chain: The LangChain RunnableSequence for query expansion.
+        model: The side model used for query expansion.
+        api_key: The API key for the side model.
 
     Returns:
         A list of queries, with the original query always as the first element.
         Returns [query] if expansion fails.
     """
-    if query_expansion_chain is None:
-        logger.error("Cannot retrieve query expansion chain. Using original query.")
+    if not model or not api_key or "instructions" not in QUERY_EXP_PROMPTS:
+        logger.error("Cannot expand query without a side model, API key and prompt. Using original query.")
         return [query]
+    if len(query.strip()) < env.QUERY_EXPANSION_MIN_CHARS or is_literal_query(query):
+        logger.info("Query too short or literal to benefit from expansion. Using original query.")
+        return [query]
+
+    history_str = format_history_for_prompt(history)[:4000]
+    # Same side model, normalized question and history -> same expansion, without another LLM round trip
+    cache_key = (model, " ".join(query.lower().split()), content_hash(history_str))
+    cached_queries = EXPANSION_CACHE.get(cache_key)
+    if cached_queries is not None:
+        logger.info(f"Expanded queries (cached): {cached_queries}")
+        return [query] + cached_queries
 
     try:
-        history_str = format_history_for_prompt(history)
-        gen_exp_queries = await query_expansion_chain.ainvoke({"question": query, "chat_history": history_str[:4000]})
-        expanded_queries = gen_exp_queries.queries if hasattr(gen_exp_queries, "queries") else []
+        prompt = QUERY_EXP_PROMPTS["instructions"].format(question=query, chat_history=history_str, format_instructions=QUERY_EXP_FORMAT_INSTRUCTIONS)
+        request_data = LLMRequest(
+            messages=[{"role": "user", "content": prompt}], model=model, api_key=api_key, temperature=0.0, stream=False, response_format={"type": "json_object"}
+        )
+        response = await post_with_retry(env.LLM_GATEWAY_URL + "/chat/completions", request_data.model_dump(exclude_none=True))
+        content = orjson.loads(response.content)["choices"][0]["message"]["content"]
+        expanded_queries = ExpandedQueries.model_validate_json(content).queries
         logger.info(f"Generated {len(expanded_queries)} expanded queries: {expanded_queries}")
+        EXPANSION_CACHE.set(cache_key, expanded_queries)
         return [query] + expanded_queries
     except Exception as e:
         logger.warning(f"Query expansion failed: {e}. Using original query.")
         return [query]
 
 
-async def retrieve_and_deduplicate_documents(retriever: ParentDocumentRetriever, queries: List[str]) -> List:
+async def retrieve_and_deduplicate_documents(
+    retriever: ParentDocumentRetriever, queries: List[str], seen_hashes: Optional[Set[str]] = None, distances: Optional[List[float]] = None
+) -> List:
     """
     Retrieves documents for multiple queries in parallel and removes duplicates.
 
     Args:
         retriever: The document retriever instance.
         queries: A list of queries to retrieve documents for.
+        seen_hashes: Fingerprints of documents already retrieved for this request, updated in place.
+        distances: If given, filled with the best child distance of each returned document, in the same order.
 
     Returns:
         A list of unique documents.
     """
-    tasks = [retriever.ainvoke(q) for q in queries]
-    nested_docs = await asyncio.gather(*tasks)
-
-    flat_list = [doc for sublist in nested_docs for doc in sublist]
-
-    seen_contents = set()
+    if not queries:
+        return []
+
+    # Same steps as ParentDocumentRetriever.ainvoke, batched: one ONNX pass embeds every query,
+    # child chunks for all vectors come back from a single SQL, and all their parents in a single docstore round trip
+    vectorstore = retriever.vectorstore
+    query_vectors = await asyncio.to_thread(vectorstore.embeddings.embed_queries, queries)
+
+    if set(retriever.search_kwargs) <= {"k"}:
+        async with RETRIEVAL_SEMAPHORE:
+            parent_distances = await search_parent_ids(vectorstore.collection_name, query_vectors, retriever.search_kwargs.get("k", 4), retriever.id_key)
+    else:
+        # Metadata filters and other search options go through PGVector, one search per vector
+        async def bounded_search(query_vector: List[float]) -> List:
+            async with RETRIEVAL_SEMAPHORE:
+                return await vectorstore.asimilarity_search_with_score_by_vector(query_vector, **retriever.search_kwargs)
+
+        nested_children = await asyncio.gather(*(bounded_search(v) for v in query_vectors))
+        parent_distances = {}
+        for children in nested_children:
+            for child, distance in children:
+                if retriever.id_key in child.metadata:
+                    parent_distances.setdefault(child.metadata[retriever.id_key], distance)
+
+    parent_docs = await retriever.docstore.amget(list(parent_distances))
+
+    # Short fingerprints instead of keeping every full parent text in the set
+    if seen_hashes is None:
+        seen_hashes = set()
     unique_docs = []
-    for doc in flat_list:
-        if doc.page_content not in seen_contents:
-            seen_contents.add(doc.page_content)
+    for doc, distance in zip(parent_docs, parent_distances.values()):
+        if doc is None:
+            continue
+        fingerprint = content_fingerprint(doc)
+        if fingerprint not in seen_hashes:
+            seen_hashes.add(fingerprint)
             unique_docs.append(doc)
+            if distances is not None:
+                distances.append(distance)
 
     logger.info(f"Retrieved {len(unique_docs)} unique document chunks.")
     return unique_docs
 
 
-def rerank_documents(query: str, docs: List, reranker: Optional[TextCrossEncoder] = None, threshold: float = 0.0) -> List:
+# Top-k child chunks of every query vector in one round trip (cosine distance, PGVector's default strategy)
+MULTI_VECTOR_SEARCH_SQL = text(
     """
-    Reranks a list of documents based on relevance to the query.
+    SELECT d.parent_id, d.distance
+    FROM unnest(CAST(:query_vectors AS text[])) WITH ORDINALITY AS q(vec, idx)
+    CROSS JOIN LATERAL (
+        SELECT e.cmetadata ->> :id_key AS parent_id, e.embedding <=> CAST(q.vec AS vector) AS distance
+        FROM langchain_pg_embedding e
+        WHERE e.collection_id = (SELECT uuid FROM langchain_pg_collection WHERE name = :collection)
+        ORDER BY distance
+        LIMIT :k
+    ) d
+    ORDER BY q.idx, d.distance;
+    """
+)
 
-    Args:
-        query: The user's query.
-        docs: The list of documents to rerank.
-        reranker: The reranker model instance.
-        threshold: The score threshold for keeping documents.
+
+async def search_parent_ids(collection_name: str, query_vectors: List[List[float]], k: int, id_key: str) -> Dict[str, float]:
+    """
+    Searches the k nearest child chunks of each query vector with a single statement.
 
     Returns:
-        The sorted and filtered list of documents. Returns original docs if reranker is unavailable.
+        The ids of their parent documents, without duplicates, in query then distance order,
+        mapped to the distance of their first matching child.
     """
-    if not reranker or not docs:
-        return docs
+    vector_literals = ["[" + ",".join(map(str, vector)) + "]" for vector in query_vectors]
+    async with async_engine.connect() as conn:
+        result = await conn.execute(MULTI_VECTOR_SEARCH_SQL, {"query_vectors": vector_literals, "id_key": id_key, "collection": collection_name, "k": k})
+        parent_distances: Dict[str, float] = {}
+        for parent_id, distance in result:
+            if parent_id:
+                parent_distances.setdefault(parent_id, distance)
+        return parent_distances
+
+
+def content_fingerprint(doc: Document) -> str:
+    """
+    Fingerprint of a document's text: precomputed at ingestion, computed here for documents indexed before that.
+    """
+    return doc.metadata.get("_content_hash") or content_hash(doc.page_content)
 
-    MAX_DOCS_TO_RERANK = 15
-    docs_to_rerank = docs[:MAX_DOCS_TO_RERANK]
-    if len(docs) > MAX_DOCS_TO_RERANK:
-        logger.info(f"Limiting to top {MAX_DOCS_TO_RERANK} documents for reranking.")
 
-    logger.info(f"Reranking documents... (Threshold: {threshold})")
-    docs_content = [doc.page_content for doc in docs_to_rerank]
+def score_documents(query: str, docs: List, reranker: TextCrossEncoder) -> Optional[List[float]]:
+    """
+    Scores documents against the query with the cross-encoder.
+    Scores of (query, passage) pairs seen in the last RERANK_CACHE_TTL seconds are reused, only the rest is scored.
 
+    Returns:
+        One score per document, or None if reranking failed.
+    """
+    if not docs:
+        return []
+
+    query_key = content_hash(query)
+    keys = [(query_key, content_fingerprint(doc)) for doc in docs]
+    scores = [RERANK_SCORE_CACHE.get(key) for key in keys]
+    missing = [i for i, score in enumerate(scores) if score is None]
+    if not missing:
+        logger.info(f"Reranker scores (cached): {scores}")
+        return scores
+
+    # Length-sorted so each RERANKER_BATCH_SIZE batch pads to similar lengths; scores are scattered back by index below
+    missing.sort(key=lambda i: min(len(docs[i].page_content), env.RERANK_MAX_CHARS))
+    docs_content = [docs[i].page_content[: env.RERANK_MAX_CHARS] for i in missing]
     try:
-        scores = list(reranker.rerank(query=query, documents=docs_content))
-        logging.info(f"Reranker scores: {scores}")
-        doc_scores_pairs = list(zip(docs_to_rerank, scores))
-        sorted_pairs = sorted(doc_scores_pairs, key=lambda x: x[1], reverse=True)
-
-        final_docs = []
-        for doc, score in sorted_pairs:
-            if score > threshold:
-                doc.metadata["rerank_score"] = score
-                final_docs.append(doc)
-
-        if final_docs:
-            logger.info(f"{len(final_docs)} documents passed the reranker threshold of {threshold}.")
-        elif sorted_pairs:
-            best_doc, best_score = sorted_pairs[0]
-            logger.warning(f"No documents met the threshold of {threshold}. Falling back to the single best document with score {best_score:.4f}.")
-            best_doc.metadata["rerank_score"] = best_score
-            final_docs = [best_doc]
-        else:
-            final_docs = []
-
-        return final_docs
+        new_scores = list(reranker.rerank(query=query, documents=docs_content, batch_size=env.RERANKER_BATCH_SIZE))
     except Exception as e:
-        logger.warning(f"Reranking failed: {e}. Falling back to original documents.")
-        return docs_to_rerank
+        logger.warning(f"Reranking failed: {e}.")
+        return None
+
+    for i, score in zip(missing, new_scores):
+        scores[i] = score
+        RERANK_SCORE_CACHE.set(keys[i], score)
+    logger.info(f"Reranker scores ({len(docs) - len(missing)} cached): {scores}")
+    return scores
 
 
-def build_context_from_docs(docs: List, context_budget: int) -> Tuple[List[str], List[Dict[str, str]]]:
+def select_reranked_documents(docs: List, scores: List[float], threshold: float = 0.0) -> List:
     """
-    Build the context string and metadata from documents within a token budget.
+    Keeps the RERANK_TOP_K best scored documents above the threshold (or the single best one if none pass).
     """
-    context_texts = []
-    source_metadatas = []
-    current_context_tokens = 0
+    sorted_pairs = heapq.nlargest(env.RERANK_TOP_K, zip(docs, scores), key=itemgetter(1))
 
-    for doc in docs:
-        doc_tokens = count_tokens(doc.page_content)
-        if current_context_tokens + doc_tokens > context_budget:
-            logger.info("Reached RAG context token budget. Stopping context assembly.")
-            break
+    final_docs = []
+    for doc, score in sorted_pairs:
+        if score > threshold:
+            doc.metadata["rerank_score"] = score
+            final_docs.append(doc)
 
-        current_context_tokens += doc_tokens
-        context_texts.append(doc.page_content.replace("\udcc3", " ").replace("\xa0", " ").strip())
-        source_metadatas.append({"source": doc.metadata.get("source", "N/A"), "page": doc.metadata.get("page", "N/A")})
+    if final_docs:
+        logger.info(f"{len(final_docs)} documents passed the reranker threshold of {threshold}.")
+    elif sorted_pairs:
+        best_doc, best_score = sorted_pairs[0]
+        logger.warning(f"No documents met the threshold of {threshold}. Falling back to the single best document with score {best_score:.4f}.")
+        best_doc.metadata["rerank_score"] = best_score
+        final_docs = [best_doc]
 
-    unique_metadatas = [dict(t) for t in {tuple(d.items()) for d in source_metadatas}]
-    return context_texts, unique_metadatas
+    return final_docs
 
 
-def build_prompt_with_context(query: str, context: str, history: List[Dict[str, str]], strict_rule: str) -> Tuple[str, List[Dict[str, Any]]]:
+def is_clear_match(distances: List[float]) -> bool:
+    """
+    True when the best retrieved document is both very close to the query and well ahead of the runner-up:
+    the cross-encoder would not change the ranking, so scoring can be skipped. Off unless RERANK_SKIP_MAX_DISTANCE is set.
+    """
+    if not env.RERANK_SKIP_MAX_DISTANCE or len(distances) < 2:
+        return False
+    return distances[0] <= env.RERANK_SKIP_MAX_DISTANCE and distances[1] - distances[0] >= env.RERANK_SKIP_MIN_GAP
+
+
+async def retrieve_and_rerank_documents(
+    query: str,
+    history: List[Dict[str, str]],
+    retriever: ParentDocumentRetriever,
+    expansion_model: Optional[str],
+    expansion_api_key: Optional[str],
+    reranker: Optional[TextCrossEncoder] = None,
+    threshold: float = 0.0,
+) -> List:
+    """
+    Pipelined retrieval: the original query is retrieved and reranked while the expansion LLM call is in flight,
+    then only the new documents brought by the expanded queries are reranked and merged in.
+    On a clear match (see is_clear_match) the cross-encoder is skipped: expansion still runs, documents keep their
+    retrieval order and carry no rerank_score, so the threshold does not apply.
+
+    Args:
+        query: The user's query.
+        history: The chat history.
+        retriever: The document retriever instance.
+        expansion_model: The side model used for query expansion.
+        expansion_api_key: The API key for the side model.
+        reranker: The reranker model instance.
+        threshold: The score threshold for keeping documents.
+
+    Returns:
+        The sorted and filtered list of documents (unranked if the reranker is unavailable or failed).
+    """
+    loop = asyncio.get_running_loop()
+    expansion_task = asyncio.create_task(expand_query(query, history, expansion_model, expansion_api_key))
+    seen_hashes: Set[str] = set()
+    original_scores_task: Optional[asyncio.Future] = None
+    try:
+        original_distances: List[float] = []
+        original_docs = await retrieve_and_deduplicate_documents(retriever, [query], seen_hashes, original_distances)
+        skip_rerank = reranker is not None and is_clear_match(original_distances)
+        if skip_rerank:
+            logger.info(f"Top retrieval result is a clear match (distances: {original_distances[:2]}), skipping reranking.")
+        elif reranker:
+            original_docs = original_docs[:MAX_DOCS_TO_RERANK]
+            # Cross-encoder inference is CPU-bound: keep it off the event loop so other streams keep flowing
+            original_scores_task = loop.run_in_executor(RERANK_EXECUTOR, score_documents, query, original_docs, reranker)
+        expanded_queries = await expansion_task
+    except BaseException:
+        expansion_task.cancel()
+        if original_scores_task is not None:
+            original_scores_task.cancel()
+        raise
+
+    try:
+        new_docs = await retrieve_and_deduplicate_documents(retriever, expanded_queries[1:], seen_hashes)
+        if not reranker:
+            return original_docs + new_docs
+        if skip_rerank:
+            return (original_docs + new_docs)[: env.RERANK_TOP_K]
+
+        new_docs = new_docs[: MAX_DOCS_TO_RERANK - len(original_docs)]
+        logger.info(f"Reranking documents... (Threshold: {threshold})")
+        new_scores = await loop.run_in_executor(RERANK_EXECUTOR, score_documents, query, new_docs, reranker)
+        original_scores = await original_scores_task
+    finally:
+        # Not awaited when the expanded retrieval or the second scoring raised: cancel so its result is dropped, not leaked
+        if original_scores_task is not None and not original_scores_task.done():
+            original_scores_task.cancel()
+
+    docs = original_docs + new_docs
+    if original_scores is None or new_scores is None:
+        logger.warning("Falling back to original documents.")
+        return docs
+    return select_reranked_documents(docs, original_scores + new_scores, threshold)
+
+
+def build_prompt_with_context(query: str, context: str, history: List[Dict[str, str]], strict: bool) -> Tuple[str, str, List[Dict[str, Any]]]:
     """
     Build the final prompt to send to the LLM, including RAG context and history.
+    The system message only depends on the strict mode so the upstream prefix cache can reuse it across queries;
+    retrieved context goes into the last user message, right before the question.
 
     Args:
         query: user's query.
         context: Chunks of documents retrieved.
         history: chat history.
-        strict_rule: The strict rule string to append to the prompt.
+        strict: The strict RAG mode flag, selects the pre-formatted system message.
 
     Returns:
-        A Tuple with the system instruction and the list of final messages.
+        A Tuple with the system instruction, the final user message and the list of final messages.
     """
 
-    template = SYSTEM_PROMPTS["instructions"]
-    system_instruction = template.format(context=context, strict_rule=strict_rule)
-    messages = [{"role": "system", "content": system_instruction}]
-    messages.extend(history)
-    messages.append({"role": "user", "content": query})
+    system_instruction = SYSTEM_INSTRUCTIONS[strict]
+    user_message = _USER_PREFIX + context + _USER_MIDDLE + query + _USER_SUFFIX
+    messages = [{"role": "system", "content": system_instruction}, *history, {"role": "user", "content": user_message}]
 
-    return system_instruction, messages
+    return system_instruction, user_message, messages
 
 
-def build_final_prompt(query: str, history: List[Dict[str, str]], docs: List, strict: bool, window_size: int) -> Tuple[List[Dict[str, Any]], int, List[Dict[str, Any]]]:
+def document_token_counts(docs: List[Document]) -> List[int]:
+    """
+    Token count of each document: stored at ingestion, tokenized here (in one batch) for documents indexed before that.
+    """
+    counts = [doc.metadata.get("_n_tokens") for doc in docs]
+    missing = [i for i, count in enumerate(counts) if count is None]
+    for i, count in zip(missing, count_tokens_batch([docs[i].page_content for i in missing])):
+        counts[i] = count
+    return counts
+
+
+def build_final_prompt(
+    query: str, history: List[Dict[str, str]], docs: List, strict: bool, window_size: int, history_token_counts: Optional[List[int]] = None
+) -> Tuple[List[Dict[str, Any]], int, List[Dict[str, Any]]]:
     """
     Assembles the final prompt for the LLM, managing token budgets for context and history.
 
@@ -191,6 +459,8 @@ def build_final_prompt(query: str, history: List[Dict[str, str]], docs: List, st
         history: The chat history.
         docs: The retrieved and reranked documents.
         strict: The strict RAG mode flag.
+        window_size: The context window of the model.
+        history_token_counts: Per-message token counts of the history, if already computed.
 
     Returns:
         A tuple containing:
@@ -205,53 +475,48 @@ def build_final_prompt(query: str, history: List[Dict[str, str]], docs: List, st
 
     # Calculating token counts
     query_tokens = count_tokens(query)
-    strict_rule = SYSTEM_PROMPTS["strict_rule_true"] if strict else SYSTEM_PROMPTS["strict_rule_false"]
-    prompt_template = SYSTEM_PROMPTS["instructions"]
-    prompt_template_tokens = count_tokens(prompt_template + strict_rule)
+    prompt_template_tokens = SYSTEM_PROMPT_FIXED_TOKENS[strict]
 
     # Truncate history if necessary to fit budget
     history_budget = (window_size * SAFETY_MARGIN) - (query_tokens + prompt_template_tokens + CONTEXT_BUDGET + RESPONSE_BUDGET)
-    final_history = truncate_history(history, history_budget)
-    history_tokens = sum(count_tokens(message.get("content", "")) for message in final_history)
+    final_history, history_tokens = truncate_history(history, history_budget, history_token_counts)
 
     # Build context from documents
     context_for_llm = []
     source_chunks_for_frontend = []
     current_context_tokens = 0
 
-    for i, doc in enumerate(docs):
-        doc_tokens = count_tokens(doc.page_content)
+    for i, (doc, doc_tokens) in enumerate(zip(docs, document_token_counts(docs))):
         if current_context_tokens + doc_tokens > CONTEXT_BUDGET:
             logger.info("Reached RAG context token budget during prompt construction.")
             break
 
         current_context_tokens += doc_tokens
+        # Documents indexed before ingestion-time cleaning may still carry stray surrogates / nbsp
+        content = clean_text(doc.page_content)
         # Numeroted context for llm
-        context_chunk = f"[{i+1}] Content: {doc.page_content} (Source: {doc.metadata.get('source', 'N/A')} [Page {doc.metadata.get('page', 'N/A')}])"
+        context_chunk = f"[{i+1}] Content: {content} (Source: {doc.metadata.get('source', 'N/A')} [Page {doc.metadata.get('page', 'N/A')}])"
         context_for_llm.append(context_chunk)
 
         # Sources map for frontend
-        source_chunks_for_frontend.append(
-            {"index": i + 1, "content": doc.page_content, "source": doc.metadata.get("source", "N/A"), "page": doc.metadata.get("page", "N/A")}
-        )
+        source_chunks_for_frontend.append({"index": i + 1, "content": content, "source": doc.metadata.get("source", "N/A"), "page": doc.metadata.get("page", "N/A")})
 
     final_context_str = "\n\n".join(context_for_llm)
     if not final_context_str:
         logger.warning("No relevant documents were added to the final context.")
 
     # Assemble final prompt
-    system_instructions, messages = build_prompt_with_context(query, final_context_str, final_history, strict_rule)
-    total_tokens = query_tokens + history_tokens + count_tokens(system_instructions)
-    logger.info(
-        f"Final prompt assembled. Tokens - Total: {total_tokens}, Query: {query_tokens}, " f"History: {history_tokens}, Instructions: {count_tokens(system_instructions)}"
-    )
+    system_instructions, user_message, messages = build_prompt_with_context(query, final_context_str, final_history, strict)
+    instructions_tokens = SYSTEM_INSTRUCTIONS_TOKENS[strict]
+    total_tokens = history_tokens + instructions_tokens + count_tokens(user_message)
+    logger.info(f"Final prompt assembled. Tokens - Total: {total_tokens}, Query: {query_tokens}, History: {history_tokens}, Instructions: {instructions_tokens}")
 
     return messages, total_tokens, source_chunks_for_frontend
 
 
 async def stream_llm_response(
     messages: List[Dict[str, Any]], token_count: int, temp: Optional[float] = 0.2, model: Optional[str] = None, api_key: Optional[str] = None
-) -> AsyncGenerator[str, None]:
+) -> AsyncGenerator[bytes, None]:
     """
     Constructs the final prompt, calls the LLM, and streams the response.
 
@@ -261,7 +526,7 @@ async def stream_llm_response(
         temp: The temperature for the LLM.
 
     Yields:
-        JSON strings representing chunks of the LLM's response or an error.
+        Complete SSE lines (newline included) of the LLM's response, or a JSON error line.
     """
     logger.info(f"Invoking LLM... (model: {model}, temp: {temp}, tokens: {token_count})")
 
@@ -269,16 +534,25 @@ async def stream_llm_response(
         request_data = LLMRequest(messages=messages, model=model, api_key=api_key, temperature=temp, stream=True)
         request_payload = request_data.model_dump(exclude_none=True)
         gateway_url = env.LLM_GATEWAY_URL + "/chat/completions"
-        async with httpx.AsyncClient(timeout=None) as client:
-            async with client.stream("POST", gateway_url, json=request_payload) as response:
-                response.raise_for_status()
-                async for text_chunk in response.aiter_text():
-                    yield text_chunk
+        response = await open_stream_with_retry(gateway_url, request_payload)
+        try:
+            # Raw bytes split on newlines: no incremental UTF-8 decoding, and a network chunk
+            # holding several events (or half of one) still comes out as whole lines
+            buffer = b""
+            async for raw in response.aiter_bytes():
+                buffer += raw
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    yield line + b"\n"
+            if buffer:
+                yield buffer + b"\n"
+        finally:
+            await response.aclose()
         logger.info("LLM stream completed.")
 
     except httpx.RequestError as e:
         logger.error(f"Request failed: {e}")
-        yield json.dumps({"type": "error", "content": str(e)}) + "\n"
+        yield orjson.dumps({"type": "error", "content": str(e)}) + b"\n"
     except Exception as e:
         logger.error(f"An unexpected error occurred: {e}")
-        yield json.dumps({"type": "error", "content": str(e)}) + "\n"
+        yield orjson.dumps({"type": "error", "content": str(e)}) + b"\n"
@@ -1,10 +1,17 @@
-import json
+import asyncio
+import hashlib
 import logging
-from typing import Any, Dict, List
+import random
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
 
 import httpx
+import orjson
 import tiktoken
-from langchain_classic.load import dumps, loads
+from langchain_classic.load import dumpd, load, loads
 
 from core.config import settings as env
 from database import crud
@@ -22,18 +29,138 @@ def format_history_for_prompt(history: List[Dict[str, str]]) -> str:
 
     if not history:
         return "No history yet."
-    formatted_messages = [
-        f"{msg.get('role', 'unknown')}: {msg.get('content', '')}" for msg in history if isinstance(msg, dict) and msg.get("role") and msg.get("content")
-    ]
-    return "\n".join(formatted_messages)
+    return _format_history_cached(tuple((msg.get("role"), msg.get("content")) for msg in history if isinstance(msg, dict) and msg.get("role") and msg.get("content")))
+
+
+@lru_cache(maxsize=256)
+def _format_history_cached(messages: Tuple[Tuple[str, str], ...]) -> str:
+    # Keyed on the (role, content) pairs: retried or repeated turns reuse the joined string
+    return "\n".join(f"{role}: {content}" for role, content in messages)
+
+
+# Stray surrogates and non-breaking spaces left by PDF extraction, replaced in one C-level pass
+CLEAN_TABLE = str.maketrans({"\udcc3": " ", "\xa0": " "})
+
+
+def clean_text(text: str) -> str:
+    """
+    Normalizes extracted text once at ingestion, so retrieved chunks go to the prompt as-is.
+    """
+    return text.translate(CLEAN_TABLE).strip()
+
+
+def content_hash(text: str) -> str:
+    """
+    Short blake2b fingerprint of a text, stored at ingestion and used as dedup / cache key instead of the full string.
+    """
+    return hashlib.blake2b(text.encode("utf-8", "ignore"), digest_size=16).hexdigest()
 
 
 def value_serializer(value: Any) -> bytes:
-    return json.dumps(dumps(value)).encode("utf-8")
+    """
+    Docstore encoding: the LangChain serializable dict written once as JSON bytes by orjson.
+    """
+    return orjson.dumps(dumpd(value))
 
 
 def value_deserializer(data: bytes) -> Any:
-    return loads(json.loads(data.decode("utf-8")))
+    """
+    Reads both the current encoding and the older one (LangChain's JSON string, JSON-encoded a second time).
+    """
+    obj = orjson.loads(data)
+    if isinstance(obj, str):
+        return loads(obj)
+    return load(obj)
+
+
+class TTLCache:
+    """
+    Small thread-safe LRU cache whose entries expire ttl seconds after being set.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Any, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+# --- Shared HTTP client ---
+_HTTP_CLIENT: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Lazy singleton: one connection pool to the LLM gateway for the whole process.
+    No timeout, LLM streams can stay open for a long time.
+    """
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is None:
+        _HTTP_CLIENT = httpx.AsyncClient(timeout=None, limits=httpx.Limits(max_connections=200, max_keepalive_connections=100))
+    return _HTTP_CLIENT
+
+
+async def _send_with_retry(url: str, payload: Dict[str, Any], retries: int, stream: bool, timeout: Optional[httpx.Timeout] = None) -> httpx.Response:
+    client = get_http_client()
+    for attempt in range(retries + 1):
+        response = None
+        try:
+            response = await client.send(client.build_request("POST", url, json=payload, timeout=timeout), stream=stream)
+            response.raise_for_status()
+            return response
+        except httpx.HTTPStatusError as e:
+            await response.aclose()
+            if attempt == retries or (e.response.status_code != 429 and e.response.status_code < 500):
+                raise
+            logger.warning(f"Gateway returned {e.response.status_code}, retrying ({attempt + 1}/{retries})...")
+        except httpx.RequestError as e:
+            if attempt == retries:
+                raise
+            logger.warning(f"Gateway request failed: {e}, retrying ({attempt + 1}/{retries})...")
+        await asyncio.sleep(min(8.0, 0.5 * 2**attempt) * random.uniform(0.8, 1.2))
+
+
+async def post_with_retry(url: str, payload: Dict[str, Any], retries: int = env.GATEWAY_MAX_RETRIES) -> httpx.Response:
+    """
+    Non-streaming POST on the shared client, retried on connection errors, 429 and 5xx.
+    Exponential backoff capped at 8s with +/-20% jitter, so clients don't all retry together when the gateway recovers.
+    The shared client has no timeout: each attempt gets GATEWAY_TIMEOUT so a hung gateway turns into a retry instead of a stuck request.
+    """
+    return await _send_with_retry(url, payload, retries, stream=False, timeout=httpx.Timeout(env.GATEWAY_TIMEOUT, connect=5.0))
+
+
+async def open_stream_with_retry(url: str, payload: Dict[str, Any], retries: int = env.GATEWAY_MAX_RETRIES) -> httpx.Response:
+    """
+    Streaming POST on the shared client: only the connect/headers phase is retried like post_with_retry,
+    once the body starts flowing nothing is replayed. The caller iterates the response and must aclose() it.
+    """
+    return await _send_with_retry(url, payload, retries, stream=True)
+
+
+async def close_http_client() -> None:
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is not None:
+        await _HTTP_CLIENT.aclose()
+        _HTTP_CLIENT = None
 
 
 # --- Token count and optimizations ---
@@ -46,29 +173,56 @@ except Exception:
 def count_tokens(text: str) -> int:
     """
     Count the number of tokens in a text.
+    encode_ordinary skips the special-token scan, and user text that looks like one (e.g. "<|endoftext|>") is counted instead of raising.
     """
-    return len(tokenizer.encode(text))
+    return len(tokenizer.encode_ordinary(text))
 
 
-def truncate_history(history: List[Dict[str, str]], max_tokens: int) -> List[Dict[str, str]]:
+@lru_cache(maxsize=4096)
+def count_tokens_cached(text: str) -> int:
     """
-    Truncate history to stay within the context window.
+    Memoized count_tokens for texts that come back request after request (chat history messages).
     """
-    if sum(count_tokens(message.get("content", "")) for message in history) <= max_tokens:
-        return history
+    return count_tokens(text)
 
-    current_tokens = 0
-    truncated_history = []
 
-    for message in reversed(history):
-        message_tokens = count_tokens(message.get("content", ""))
-        if (current_tokens + message_tokens) <= max_tokens:
-            truncated_history.insert(0, message)
-            current_tokens += message_tokens
-        else:
+def count_history_tokens(history: List[Dict[str, str]]) -> List[int]:
+    """
+    Per-message token counts of the history: only messages not seen in earlier turns get encoded.
+    """
+    return [count_tokens_cached(message.get("content", "")) for message in history]
+
+
+def count_tokens_batch(texts: List[str]) -> List[int]:
+    """
+    Count the tokens of several texts in one call (tiktoken encodes the batch in parallel, outside the GIL).
+    """
+    if not texts:
+        return []
+    return [len(tokens) for tokens in tokenizer.encode_ordinary_batch(texts)]
+
+
+def truncate_history(history: List[Dict[str, str]], max_tokens: int, message_tokens: Optional[List[int]] = None) -> Tuple[List[Dict[str, str]], int]:
+    """
+    Truncate history to stay within the context window, keeping the most recent messages.
+    message_tokens may hold the per-message token counts when they were computed ahead of time.
+    Returns the kept messages and their token count.
+    """
+    if message_tokens is None:
+        message_tokens = count_history_tokens(history)
+    total_tokens = sum(message_tokens)
+    if total_tokens <= max_tokens:
+        return history, total_tokens
+
+    current_tokens = 0
+    start = len(history)
+    for i in range(len(history) - 1, -1, -1):
+        if current_tokens + message_tokens[i] > max_tokens:
             break
+        current_tokens += message_tokens[i]
+        start = i
 
-    return truncated_history
+    return history[start:], current_tokens
 
 
 def create_service_user():
@@ -94,32 +248,43 @@ def create_service_user():
         db.close()
 
 
+_CONTEXT_WINDOWS = TTLCache(maxsize=64, ttl=300)
+
+
 async def get_context_window(model_name: str):
-    model_info_url = f"{env.LLM_GATEWAY_URL}/model/info"
-    async with httpx.AsyncClient() as client:
-        response = await client.get(model_info_url)
-        response.raise_for_status()
-        all_models_info = response.json()
-        models_list = all_models_info.get("data", [])
-        model_config = next(
-            (
-                model
-                for model in models_list
-                if (
-                    model.get("model_name") == model_name
-                    or model.get("litellm_params", {}).get("model") == model_name
-                    or model.get("model_info", {}).get("key") == model_name
-                )
-            ),
-            None,
-        )
-
-        context_window = None
-        if model_config:
-            context_window = model_config.get("model_info", {}).get("max_input_tokens")
-        if context_window is None:
-            context_window = env.LLM_MAX_CONTEXT_TOKENS
-            logger.warning(f"Context window info not found for model {model_name}. Using default value: {context_window}.")
-        else:
-            logger.info(f"Successfully retrieved and set context window for {model_name}: {context_window} tokens.")
+    """
+    Context window of a model from the gateway's model info, cached for a few minutes per model.
+    """
+    context_window = _CONTEXT_WINDOWS.get(model_name)
+    if context_window is not None:
         return context_window
+
+    model_info_url = f"{env.LLM_GATEWAY_URL}/model/info"
+    # Short metadata call over the shared pool, with httpx's usual 5s timeout instead of the stream's none
+    response = await get_http_client().get(model_info_url, timeout=5.0)
+    response.raise_for_status()
+    all_models_info = response.json()
+    models_list = all_models_info.get("data", [])
+    model_config = next(
+        (
+            model
+            for model in models_list
+            if (
+                model.get("model_name") == model_name
+                or model.get("litellm_params", {}).get("model") == model_name
+                or model.get("model_info", {}).get("key") == model_name
+            )
+        ),
+        None,
+    )
+
+    context_window = None
+    if model_config:
+        context_window = model_config.get("model_info", {}).get("max_input_tokens")
+    if context_window is None:
+        context_window = env.LLM_MAX_CONTEXT_TOKENS
+        logger.warning(f"Context window info not found for model {model_name}. Using default value: {context_window}.")
+    else:
+        logger.info(f"Successfully retrieved and set context window for {model_name}: {context_window} tokens.")
+    _CONTEXT_WINDOWS.set(model_name, context_window)
+    return context_window